@@ -0,0 +1,127 @@
+import os
+import gzip
+import json
+import asyncio
+import sqlite3
+import datetime
+import contextlib
+import attr
+from .base import Run, Status
+
+# maps each archived run's uuid to the batch file it's in
+INDEX_FILENAME = "index.sqlite3"
+
+
+def _run_to_json(run):
+    values = attr.asdict(run)
+    values["status"] = run.status.name
+    return json.dumps(values)
+
+
+def _json_to_run(line):
+    values = json.loads(line)
+    values["status"] = Status[values["status"]]
+    return Run(**values)
+
+
+class RunArchive:
+    """
+    Moves finished runs past the retention limits out of storage and into
+    gzipped JSON-lines files, one per batch, with an index of which file each
+    run is in.  File access happens on a thread so it doesn't block the event loop.
+
+    BOBSLED_RETENTION_RUNS keeps the latest n runs of each task and
+    BOBSLED_RETENTION_DAYS keeps runs from the last n days, a run kept by either
+    is kept.  The latest failure of each task is always kept.  Nothing is archived
+    unless BOBSLED_ARCHIVE_DIRNAME and at least one limit are set.
+    """
+
+    def __init__(
+        self,
+        *,
+        storage,
+        BOBSLED_ARCHIVE_DIRNAME=None,
+        BOBSLED_RETENTION_RUNS=None,
+        BOBSLED_RETENTION_DAYS=None,
+    ):
+        self.storage = storage
+        self.dirname = BOBSLED_ARCHIVE_DIRNAME
+        self.keep_runs = int(BOBSLED_RETENTION_RUNS) if BOBSLED_RETENTION_RUNS else None
+        self.keep_days = int(BOBSLED_RETENTION_DAYS) if BOBSLED_RETENTION_DAYS else None
+
+    @property
+    def enabled(self):
+        return bool(self.dirname and (self.keep_runs or self.keep_days))
+
+    async def archive_expired(self, now=None, batch_size=1000):
+        """
+        Archive up to batch_size expired runs, oldest first.
+
+        Returns the number archived, so a backlog can be drained in batches.
+        """
+        if not self.enabled:
+            return 0
+        if not now:
+            now = datetime.datetime.utcnow()
+        keep_before = None
+        if self.keep_days:
+            keep_before = (now - datetime.timedelta(days=self.keep_days)).isoformat()
+        runs = await self.storage.get_expired_runs(
+            keep_runs=self.keep_runs, keep_before=keep_before, limit=batch_size
+        )
+        if not runs:
+            return 0
+        for run in runs:
+            run.logs = await self.storage.get_logs(run.uuid)
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.write_batch, runs, now
+        )
+        # a crash before this point leaves the runs in storage to be archived again
+        await self.storage.delete_runs([run.uuid for run in runs])
+        return len(runs)
+
+    def _index(self):
+        connection = sqlite3.connect(os.path.join(self.dirname, INDEX_FILENAME))
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS runs (uuid TEXT PRIMARY KEY, filename TEXT)"
+        )
+        return contextlib.closing(connection)
+
+    def write_batch(self, runs, now):
+        os.makedirs(self.dirname, exist_ok=True)
+        filename = f"runs-{now:%Y%m%d%H%M%S}-{runs[0].uuid[:8]}.jsonl.gz"
+        path = os.path.join(self.dirname, filename)
+        with gzip.open(path + ".tmp", "wt") as f:
+            for run in runs:
+                f.write(_run_to_json(run) + "\n")
+        os.replace(path + ".tmp", path)
+        with self._index() as index:
+            # the connection's context manager commits
+            with index:
+                index.executemany(
+                    "INSERT OR REPLACE INTO runs VALUES (?, ?)",
+                    [(run.uuid, filename) for run in runs],
+                )
+
+    async def get_run(self, run_id):
+        """Read an archived run back, returns None if it isn't in the archive."""
+        if not self.dirname:
+            return None
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._read_run, run_id
+        )
+
+    def _read_run(self, run_id):
+        if not os.path.exists(os.path.join(self.dirname, INDEX_FILENAME)):
+            return None
+        with self._index() as index:
+            row = index.execute(
+                "SELECT filename FROM runs WHERE uuid = ?", (run_id,)
+            ).fetchone()
+        if not row:
+            return None
+        with gzip.open(os.path.join(self.dirname, row[0]), "rt") as f:
+            for line in f:
+                run = _json_to_run(line)
+                if run.uuid == run_id:
+                    return run
@@ -1,5 +1,7 @@
 import attr
 import enum
+import time
+import asyncio
 import uuid
 import datetime
 import typing
@@ -14,11 +16,16 @@ class Status(enum.Enum):
     UserKilled = 5
     TimedOut = 6
     Missing = 7
+    Queued = 8
 
     def is_terminal(self):
         return self.value in (3, 4, 5, 6, 7)
 
 
+ACTIVE_STATUSES = [Status.Pending, Status.Running, Status.Queued]
+FAILED_STATUSES = [Status.Error, Status.TimedOut]
+
+
 @attr.s(auto_attribs=True)
 class Environment:
     name: str
@@ -45,6 +52,7 @@ class Task:
     error_threshold: int = 3
     triggers: typing.List[Trigger] = []
     next_tasks: typing.List[str] = []
+    priority: int = 0
 
     def __attrs_post_init__(self):
         if isinstance(self.entrypoint, str):
@@ -63,6 +71,40 @@ class Run:
     uuid: str = attr.Factory(lambda: uuid.uuid4().hex)
 
 
+@attr.s(auto_attribs=True)
+class ScheduleEntry:
+    task: str
+    cron: str
+    next_run: str = ""
+    last_fired: str = ""
+
+
+@attr.s(auto_attribs=True)
+class TaskChanges:
+    added: typing.List[str] = attr.Factory(list)
+    changed: typing.List[str] = attr.Factory(list)
+    removed: typing.List[str] = attr.Factory(list)
+
+    @property
+    def updated(self):
+        """names of the tasks that were added or changed"""
+        return self.added + self.changed
+
+
+def diff_tasks(stored, tasks):
+    """Compare stored tasks against a new task list, by name."""
+    stored = {task.name: task for task in stored}
+    changes = TaskChanges()
+    for task in tasks:
+        if task.name not in stored:
+            changes.added.append(task.name)
+        elif stored[task.name] != task:
+            changes.changed.append(task.name)
+    names = {task.name for task in tasks}
+    changes.removed = [name for name in stored if name not in names]
+    return changes
+
+
 @attr.s(auto_attribs=True)
 class User:
     username: str
@@ -70,13 +112,90 @@ class User:
     permissions: typing.List[str] = []
 
 
+@attr.s(auto_attribs=True)
+class StatusFlight:
+    """A reconciliation of runs with their runner, shared by concurrent callers."""
+
+    started: float
+    update_logs: bool
+    future: asyncio.Future
+
+    def covers(self, now, max_age, update_logs):
+        if update_logs and not self.update_logs:
+            return False
+        if self.future.done() and (self.future.cancelled() or self.future.exception()):
+            return False
+        return now - self.started <= max_age
+
+
+class AdmissionPolicy:
+    """
+    Limits on how many runs can be Pending or Running at once.
+
+    BOBSLED_MAX_RUNNING caps the total, BOBSLED_TAG_LIMITS caps runs per task tag
+    and is formatted like "tag1=5,tag2=2".
+    """
+
+    def __init__(self, BOBSLED_MAX_RUNNING=None, BOBSLED_TAG_LIMITS=""):
+        self.max_running = int(BOBSLED_MAX_RUNNING) if BOBSLED_MAX_RUNNING else None
+        self.tag_limits = {}
+        for item in BOBSLED_TAG_LIMITS.split(","):
+            if item.strip():
+                tag, limit = item.split("=")
+                self.tag_limits[tag.strip()] = int(limit)
+
+    def admits(self, task, active_runs):
+        if self.max_running is not None and len(active_runs) >= self.max_running:
+            return False
+        for tag in task.tags:
+            limit = self.tag_limits.get(tag)
+            if limit is not None:
+                n_tagged = sum(tag in r.run_info.get("tags", []) for r in active_runs)
+                if n_tagged >= limit:
+                    return False
+        return True
+
+
 class RunService:
+    admission = AdmissionPolicy()
+    # a run reconciled with its runner this recently is read from storage instead
+    STATUS_FRESH_SECONDS = 1
+    # a run claimed from the queue that hasn't started by now never will, the
+    # process that claimed it died before it could save the started run
+    CLAIM_TIMEOUT_SECONDS = 600
+
     async def run_task(self, task):
-        running = await self.get_runs(
-            status=[Status.Pending, Status.Running], task_name=task.name
-        )
-        if running:
+        """
+        Start a run of task, or queue it if that would exceed the admission limits.
+        """
+        active = await self.storage.get_runs(status=ACTIVE_STATUSES)
+        if any(run.task == task.name for run in active):
             raise AlreadyRunning()
+
+        queued = [run for run in active if run.status == Status.Queued]
+        if not queued and self.admission.admits(task, active):
+            run = Run(task.name, self.STARTING_STATUS)
+            await self._start_run(task, run)
+            await self.storage.add_run(run)
+            return run
+        return await self.queue_task(task)
+
+    async def queue_task(self, task):
+        """
+        Queue a run of task, it starts once the limits allow and no other run of
+        the task is active.
+        """
+        run = Run(
+            task.name,
+            Status.Queued,
+            start=datetime.datetime.utcnow().isoformat(),
+            run_info={"priority": task.priority, "tags": task.tags},
+        )
+        await self.storage.add_run(run)
+        await self.drain_queue()
+        return await self.storage.get_run(run.uuid)
+
+    async def _start_run(self, task, run):
         run_info = self.start_task(task)
         now = datetime.datetime.utcnow()
         timeout_at = ""
@@ -85,15 +204,232 @@ class RunService:
                 now + datetime.timedelta(minutes=task.timeout_minutes)
             ).isoformat()
         run_info["timeout_at"] = timeout_at
+        run_info["tags"] = task.tags
 
-        run = Run(
-            task.name, self.STARTING_STATUS, start=now.isoformat(), run_info=run_info
-        )
-        await self.storage.add_run(run)
+        run.status = self.STARTING_STATUS
+        run.start = now.isoformat()
+        run.run_info = run_info
+
+    async def drain_queue(self):
+        """
+        Start queued runs, highest priority first, while the limits allow.
+
+        Returns the runs that were started.
+        """
+        started = []
+        async with self._drain_lock:
+            runs = await self.storage.get_runs(status=ACTIVE_STATUSES)
+            active = [run for run in runs if run.status != Status.Queued]
+            queued = [run for run in runs if run.status == Status.Queued]
+            queued.sort(key=lambda r: (-r.run_info.get("priority", 0), r.start))
+            for run in queued:
+                try:
+                    task = await self.storage.get_task(run.task)
+                except KeyError:
+                    task = None
+                if not task:
+                    run.status = Status.Missing
+                    run.end = datetime.datetime.utcnow().isoformat()
+                    await self.storage.save_run(run)
+                    continue
+                # a task can have several queued runs, they start one at a time
+                if any(r.task == run.task for r in active):
+                    continue
+                if not self.admission.admits(task, active):
+                    continue
+                # the lock only covers this process, the claim keeps other
+                # processes draining the same queue from starting the run too
+                queued_at = run.start
+                claimed_at = datetime.datetime.utcnow().isoformat()
+                if not await self.storage.claim_queued_run(
+                    run.uuid, self.STARTING_STATUS, claimed_at
+                ):
+                    continue
+                try:
+                    await self._start_run(task, run)
+                except Exception:
+                    run.status = Status.Error
+                    run.end = datetime.datetime.utcnow().isoformat()
+                    await self.storage.save_run(run)
+                    raise
+                run.run_info["queued_at"] = queued_at
+                await self.storage.save_run(run)
+                active.append(run)
+                started.append(run)
+        return started
+
+    async def expire_claims(self):
+        """
+        Error out runs that were claimed from the queue but never started.
+
+        Returns the runs.
+        """
+        now = datetime.datetime.utcnow()
+        cutoff = (
+            now - datetime.timedelta(seconds=self.CLAIM_TIMEOUT_SECONDS)
+        ).isoformat()
+        expired = []
+        for run in await self.storage.get_runs(status=ACTIVE_STATUSES):
+            # claimed_at is dropped once the run starts
+            claimed_at = run.run_info.get("claimed_at")
+            if claimed_at and claimed_at < cutoff:
+                run.status = Status.Error
+                run.end = now.isoformat()
+                await self._save_and_followup(run)
+                expired.append(run)
+        return expired
+
+    async def update_status(self, run_id, update_logs=False, max_age=None):
+        """Update the status of a run from its runner, see update_statuses."""
+        run = await self.storage.get_run(run_id, logs=update_logs)
+        (run,) = await self.update_statuses([run], update_logs, max_age)
         return run
 
+    async def update_statuses(self, runs, update_logs=False, max_age=None):
+        """
+        Update the status of many runs, returning them in the same order.
+
+        Concurrent calls for a run share one reconciliation with its runner, and
+        runs reconciled in the last max_age seconds (STATUS_FRESH_SECONDS by
+        default) are read from storage instead.  A run is never reconciled twice
+        at once, so followups (next tasks, callbacks) only happen once.
+        """
+        if max_age is None:
+            max_age = self.STATUS_FRESH_SECONDS
+        now = time.monotonic()
+        # finished flights stop being useful once they're too old to cover a call
+        fresh = max(max_age, self.STATUS_FRESH_SECONDS)
+        for run_id, flight in list(self._flights.items()):
+            if flight.future.done() and now - flight.started > fresh:
+                del self._flights[run_id]
+        active = {
+            run.uuid
+            for run in runs
+            if not run.status.is_terminal() and run.status != Status.Queued
+        }
+        in_flight = {}
+        stale = []
+        for run_id in [run.uuid for run in runs if run.uuid in active]:
+            flight = self._flights.get(run_id)
+            if not flight or not flight.covers(now, max_age, update_logs):
+                stale.append(run_id)
+            elif not flight.future.done():
+                in_flight[id(flight)] = flight
+
+        if stale:
+            # a run is only reconciled once any reconciliation already under way ends
+            previous = {
+                self._flights[run_id].future
+                for run_id in stale
+                if run_id in self._flights and not self._flights[run_id].future.done()
+            }
+            future = asyncio.ensure_future(
+                self._reconcile(stale, update_logs, previous)
+            )
+            flight = StatusFlight(now, update_logs, future)
+            for run_id in stale:
+                self._flights[run_id] = flight
+            in_flight[id(flight)] = flight
+
+        updated = {}
+        for flight in in_flight.values():
+            # one caller going away shouldn't cancel the reconciliation for the others
+            updated.update(await asyncio.shield(flight.future))
+        results = []
+        for run in runs:
+            if run.uuid in updated:
+                run = updated[run.uuid]
+            elif run.uuid in active:
+                # reconciled recently, or finished by someone else in the meantime
+                run = await self.storage.get_run(run.uuid, logs=update_logs) or run
+            results.append(run)
+        return results
+
+    async def _reconcile(self, run_ids, update_logs, previous):
+        """one flight: wait for any earlier ones, then update the runs as stored"""
+        if previous:
+            await asyncio.wait(previous)
+        runs = []
+        for run_id in run_ids:
+            run = await self.storage.get_run(run_id, logs=update_logs)
+            # stored state may have moved on since the caller read it, and runs
+            # claimed from the queue have nothing to reconcile until they start
+            if (
+                run
+                and not run.status.is_terminal()
+                and run.status != Status.Queued
+                and "claimed_at" not in run.run_info
+            ):
+                runs.append(run)
+            else:
+                self._end_flight(run_id)
+        runs = await self._update_statuses(runs, update_logs)
+        for run in runs:
+            if run.status.is_terminal():
+                self._end_flight(run.uuid)
+        return {run.uuid: run for run in runs}
+
+    def _end_flight(self, run_id):
+        """forget the current flight's run, unless a later flight has taken it over"""
+        flight = self._flights.get(run_id)
+        if flight and flight.future is asyncio.current_task():
+            del self._flights[run_id]
+
+    async def _update_statuses(self, runs, update_logs=False):
+        """
+        Update runs from the runner, runs are as stored and neither finished nor queued.
+
+        Runners that can look up several runs in one call should override this.
+        """
+        return await asyncio.gather(
+            *[self._update_status(run, update_logs=update_logs) for run in runs]
+        )
+
+    def watch_events(self, accept=None):
+        """
+        Start handling run completions as the backend reports them, if supported.
+
+        accept is an optional predicate on task names limiting which runs are handled.
+        """
+
+    async def _save_logs(self, run, logs, replace=False):
+        """
+        Store the full logs of a run so far, writing only the text added since the last call.
+
+        run_info["log_length"] tracks how much has been stored.  If the logs got
+        shorter, the stored text isn't a prefix of them, or another process appended
+        first, the stored logs are replaced.
+        """
+        stored = run.run_info.get("log_length", 0)
+        if stored and not replace and len(logs) >= stored:
+            replace = await self.storage.get_logs(run.uuid) != logs[:stored]
+        appended = (
+            not replace
+            and len(logs) > stored
+            and await self.storage.append_logs(run.uuid, stored, logs[stored:])
+        )
+        if not appended and (replace or len(logs) != stored):
+            await self.storage.replace_logs(run.uuid, logs)
+        run.logs = logs
+        run.run_info["log_length"] = len(logs)
+
+    async def _append_logs(self, run, text):
+        """Append new text to the stored logs of a run."""
+        stored = run.run_info.get("log_length", 0)
+        if not text:
+            return
+        if await self.storage.append_logs(run.uuid, stored, text):
+            run.logs += text
+            run.run_info["log_length"] = stored + len(text)
+        else:
+            # another process already stored this output
+            run.logs = await self.storage.get_logs(run.uuid)
+            run.run_info["log_length"] = len(run.logs)
+
     async def _save_and_followup(self, run):
         await self.storage.save_run(run)
+        if run.status.is_terminal():
+            await self.drain_queue()
         if run.status == Status.Success:
             # start other jobs and do on success callback
             try:
@@ -115,22 +451,52 @@ class RunService:
                 await callback.on_error(run, self.storage)
 
     async def get_runs(
-        self, *, status=None, task_name=None, latest=None, update_status=False
+        self,
+        *,
+        status=None,
+        task_name=None,
+        latest=None,
+        before=None,
+        since=None,
+        until=None,
+        update_status=False,
     ):
+        """
+        Runs newest first.
+
+        latest limits them to a page of the newest runs, and before continues
+        from a (start, uuid) cursor, usually that of the last run of the previous
+        page.  since and until limit the start times, since is inclusive.
+        """
         runs = await self.storage.get_runs(
-            status=status, task_name=task_name, latest=latest
+            status=status,
+            task_name=task_name,
+            latest=latest,
+            before=before,
+            since=since,
+            until=until,
         )
         if update_status:
-            for run in runs:
-                await self.update_status(run.uuid)
-        # sort runs old to new
+            runs = await self.update_statuses(runs)
+        # sort runs new to old, runs that started together stay in storage's
+        # order (reversed) so the last run is the cursor for the next page
+        runs.reverse()
         runs.sort(key=lambda r: r.start, reverse=True)
         return runs
 
+    async def get_latest_runs_by_task(self, n, task_names=None):
+        """The latest n runs of each task, newest first like get_runs."""
+        runs = await self.storage.get_latest_runs_by_task(n, task_names)
+        for task_runs in runs.values():
+            task_runs.sort(key=lambda r: r.start, reverse=True)
+        return runs
+
     async def stop_run(self, run_id):
         run = await self.storage.get_run(run_id)
         if not run.status.is_terminal():
-            self.stop(run)
+            if run.status != Status.Queued:
+                self.stop(run)
             run.status = Status.UserKilled
             run.end = datetime.datetime.utcnow().isoformat()
             await self.storage.save_run(run)
+            await self.drain_queue()
@@ -1,85 +1,383 @@
 import os
+import heapq
+import socket
+import hashlib
 import asyncio
 import datetime
 import zmq
-from .base import Status
+from .base import ScheduleEntry, Status, Task, Trigger
 from .core import bobsled
+from .cron import (  # noqa
+    CronSchedule,
+    compile_cron,
+    fire_times,
+    next_cron,
+    next_run_for_task,
+    next_runs_for_tasks,
+    parse_cron_segment,
+    start_histogram,
+    task_cron,
+    task_schedule,
+)
 from .exceptions import AlreadyRunning
 
+# TODO: make these configurable
+LOG_FILE = "/tmp/bobsled-beat.log"
+UPDATE_CONFIG_MINS = 120
+RECONCILE_SECONDS = 60
+# the leader archives a batch of expired runs this often, or every reconcile
+# while there is a backlog
+ARCHIVE_MINS = 60
+ARCHIVE_BATCH = 1000
+
+# what to do with fires that were missed while beat was down or behind:
+#   skip - drop them, only run fires that are less than MISSED_GRACE late
+#   once - run a task once if any of its fires were missed within the window
+#   all  - run every missed fire within the window, queued one after another
+CATCHUP_SKIP = "skip"
+CATCHUP_ONCE = "once"
+CATCHUP_ALL = "all"
+CATCHUP_POLICIES = (CATCHUP_SKIP, CATCHUP_ONCE, CATCHUP_ALL)
+MISSED_GRACE = datetime.timedelta(seconds=RECONCILE_SECONDS)
+
+# beats heartbeat every reconcile, a member that misses a few is considered gone
+# and its tasks are picked up by the remaining members
+MEMBER_TTL = datetime.timedelta(seconds=RECONCILE_SECONDS * 3)
+# fire claims only need to outlive any overlap between members
+FIRE_CLAIM_RETENTION = datetime.timedelta(days=1)
+
+
+def default_member_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def task_owner(task_name, members):
+    """
+    Pick the member responsible for a task using rendezvous hashing.
+
+    When a member joins or leaves only the tasks it owned (or will own) move.
+    """
+    return max(
+        members,
+        key=lambda member: hashlib.sha1(f"{member}/{task_name}".encode()).digest(),
+    )
+
+
+class FireQueue:
+    """
+    Min-heap of upcoming fire times keyed on task name.
+
+    Rescheduling or removing a task leaves its old heap entry in place, stale
+    entries are discarded lazily when they reach the top of the heap.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._scheduled = {}
+
+    def __len__(self):
+        return len(self._scheduled)
+
+    def __contains__(self, task_name):
+        return task_name in self._scheduled
+
+    def get(self, task_name):
+        return self._scheduled.get(task_name)
+
+    def schedule(self, task_name, fire_time):
+        self._scheduled[task_name] = fire_time
+        heapq.heappush(self._heap, (fire_time, task_name))
+
+    def remove(self, task_name):
+        self._scheduled.pop(task_name, None)
+
+    def _discard_stale(self):
+        while self._heap:
+            fire_time, task_name = self._heap[0]
+            if self._scheduled.get(task_name) == fire_time:
+                break
+            heapq.heappop(self._heap)
+
+    def peek(self):
+        """Return the earliest scheduled fire time, or None if empty."""
+        self._discard_stale()
+        if self._heap:
+            return self._heap[0][0]
+
+    def pop_due(self, now):
+        """Remove and return (task_name, fire_time) for everything due by now."""
+        due = []
+        while True:
+            self._discard_stale()
+            if not self._heap or self._heap[0][0] > now:
+                break
+            fire_time, task_name = heapq.heappop(self._heap)
+            del self._scheduled[task_name]
+            due.append((task_name, fire_time))
+        return due
+
+
+class Beat:
+    """
+    Schedules and reconciles runs for the slice of tasks this member owns.
+
+    Several beats can share one storage, each heartbeats into a membership table
+    and owns the tasks that hash to it.  Every fire is claimed in storage before
+    starting, so a fire is only started once even while members disagree about
+    ownership during a join or failover.
+    """
+
+    def __init__(
+        self,
+        storage,
+        run,
+        log=print,
+        catchup=CATCHUP_ONCE,
+        catchup_window=datetime.timedelta(hours=1),
+        spread=None,
+        member_id=None,
+    ):
+        if catchup not in CATCHUP_POLICIES:
+            raise ValueError(f"catchup must be one of {CATCHUP_POLICIES}")
+        self.storage = storage
+        self.run = run
+        self.log = log
+        self.catchup = catchup
+        self.catchup_window = catchup_window
+        self.spread = spread
+        self.queue = FireQueue()
+        self.crons = {}
+        self.last_fired = {}
+        self.member_id = member_id or default_member_id()
+        self.members = [self.member_id]
+        self.tasks = []
+
+    def owns(self, task_name):
+        return task_owner(task_name, self.members) == self.member_id
+
+    @property
+    def is_leader(self):
+        """one member also handles work that isn't per-task, like the run queue"""
+        return self.members[0] == self.member_id
+
+    async def sync_members(self, now):
+        """
+        Heartbeat and refresh the member list, reloading tasks if it changed.
 
-def parse_cron_segment(segment, star_equals):
-    if segment == "*":
-        return star_equals
-    elif "," in segment:
-        return sorted([int(n) for n in segment.split(",")])
-    elif "-" in segment:
-        start, end = segment.split("-")
-        return list(range(int(start), int(end) + 1))
-    elif segment.startswith("*/"):
-        n = int(segment[2:])
-        return list(range(0, 24, n))
-    elif segment.isdigit():
-        return [int(segment)]
-    else:
-        raise ValueError(segment)
-
-
-def next_cron(cronstr, after=None):
-    minute, hour, day, month, dow = cronstr.split()
-
-    days = parse_cron_segment(day, list(range(1, 32)))
-    minutes = parse_cron_segment(minute, list(range(60)))
-    hours = parse_cron_segment(hour, list(range(24)))
-    if dow != "?":
-        dow = parse_cron_segment(dow, list(range(7)))
-
-    # scheduling things that don't run every month not currently supported
-    assert month == "*"
-
-    if not after:
-        after = datetime.datetime.utcnow()
-    next_time = None
-
-    for month in range(1, 13):
-        for day in days:
-            for hour in hours:
-                for minute in minutes:
-                    try:
-                        next_time = after.replace(
-                            month=month,
-                            day=day,
-                            hour=hour,
-                            minute=minute,
-                            second=0,
-                            microsecond=0,
-                        )
-                        # skip wrong days of the week
-                        if dow != "?" and next_time.weekday() not in dow:
-                            continue
-                    except ValueError:
-                        # if we made an invalid time due to month rollover, skip it
-                        continue
-                    if next_time > after:
-                        return next_time
-
-    # no next time this month, set to the first time but the next month
-    if after.month == 12:
-        month = 1
-        year = after.year + 1
-        next_time = next_time.replace(
-            day=days[0], hour=hours[0], minute=minutes[0], month=month, year=year,
+        Returns True if ownership changed.
+        """
+        await self.storage.beat_heartbeat(
+            self.member_id, (now + MEMBER_TTL).isoformat()
         )
-        return next_time
+        members = await self.storage.get_beat_members(now.isoformat())
+        if self.member_id not in members:
+            members = sorted(members + [self.member_id])
+        if self.is_leader:
+            await self.storage.prune_fire_claims(
+                (now - FIRE_CLAIM_RETENTION).isoformat()
+            )
+        if members == self.members:
+            return False
+        self.log(f"{self.member_id}: beat members changed to {members}")
+        self.members = members
+        await self.load_tasks(self.tasks, now)
+        return True
 
+    async def load_tasks(self, tasks, now):
+        """
+        Sync the queue with the current task list.
 
-def next_run_for_task(task):
-    for trigger in task.triggers:
-        return next_cron(trigger.cron)
+        Only tasks owned by this member are queued.  Tasks whose trigger didn't
+        change keep their scheduled time, newly loaded or newly owned tasks use
+        the schedule persisted by a previous beat.
+        """
+        self.tasks = tasks
+        configured = {
+            task.name: task_cron(task)
+            for task in tasks
+            if task.enabled and task.triggers
+        }
+        crons = {
+            name: cronstr for name, cronstr in configured.items() if self.owns(name)
+        }
+        # tasks owned by another member keep their persisted schedule
+        removed = set(self.crons) - set(configured)
+        for task_name in set(self.crons) - set(crons):
+            self.queue.remove(task_name)
+            self.last_fired.pop(task_name, None)
+        changed = [
+            task
+            for task in tasks
+            if task.name in crons
+            and (
+                self.crons.get(task.name) != crons[task.name]
+                or task.name not in self.queue
+            )
+        ]
+        self.crons = crons
 
+        persisted = {}
+        if changed:
+            changed_names = {task.name for task in changed}
+            persisted = {
+                entry.task: entry
+                for entry in await self.storage.get_schedule()
+                if entry.task in changed_names
+                and entry.next_run
+                and entry.cron == crons[entry.task]
+                and self._is_fire_time(entry.task, entry.next_run)
+            }
+        new_entries = []
+        to_compute = []
+        for task in changed:
+            if task.name in persisted:
+                entry = persisted[task.name]
+                self.queue.schedule(
+                    task.name, datetime.datetime.fromisoformat(entry.next_run)
+                )
+                if entry.last_fired:
+                    self.last_fired[task.name] = entry.last_fired
+            else:
+                to_compute.append(task)
+        next_runs = next_runs_for_tasks(to_compute, now, self.spread)
+        for task_name, next_run in next_runs.items():
+            self.queue.schedule(task_name, next_run)
+            new_entries.append(
+                ScheduleEntry(task_name, crons[task_name], next_run.isoformat())
+            )
+        for task in changed:
+            self.log(f"{task.name} next run at {self.queue.get(task.name)}")
 
-# TODO: make these configurable
-LOG_FILE = "/tmp/bobsled-beat.log"
-UPDATE_CONFIG_MINS = 120
+        if new_entries:
+            await self.storage.save_schedule(new_entries)
+        if removed:
+            await self.storage.delete_schedule(list(removed))
+
+        await self._skip_already_fired(
+            [name for name in persisted if self.queue.get(name) <= now]
+        )
+
+    def _schedule(self, task_name):
+        return task_schedule(task_name, self.crons[task_name], self.spread)
+
+    def _is_fire_time(self, task_name, when):
+        """check a persisted time still fits the schedule, e.g. if spread changed"""
+        when = datetime.datetime.fromisoformat(when)
+        schedule = self._schedule(task_name)
+        return schedule.next_after(when - datetime.timedelta(seconds=1)) == when
+
+    def start_histogram(self, start, end):
+        """How many runs will start each minute between start and end."""
+        tasks = [
+            Task(name, "", triggers=[Trigger(cron)])
+            for name, cron in self.crons.items()
+        ]
+        times = fire_times(tasks, start, end, self.spread)
+        return start_histogram(t for task_times in times.values() for t in task_times)
+
+    async def _skip_already_fired(self, task_names):
+        """
+        Advance overdue persisted entries whose run was started before a restart.
+
+        The schedule is saved after runs start, so a crash in between leaves an
+        overdue entry for a run that already exists.
+        """
+        fired = []
+        for task_name in task_names:
+            fire_time = self.queue.get(task_name)
+            latest = await self.storage.get_runs(task_name=task_name, latest=1)
+            if latest and latest[0].start >= fire_time.isoformat():
+                fired.append((task_name, fire_time))
+        for task_name, fire_time in fired:
+            self.last_fired[task_name] = fire_time.isoformat()
+            next_run = self._schedule(task_name).next_after(fire_time)
+            if next_run:
+                self.queue.schedule(task_name, next_run)
+        if fired:
+            await self.storage.save_schedule(
+                [self._entry(task_name) for task_name, _ in fired]
+            )
+
+    def _entry(self, task_name):
+        next_run = self.queue.get(task_name)
+        return ScheduleEntry(
+            task_name,
+            self.crons[task_name],
+            next_run.isoformat() if next_run else "",
+            self.last_fired.get(task_name, ""),
+        )
+
+    def plan_fires(self, due, now):
+        """
+        Apply the catch-up policy to every due (task_name, fire_time) at once.
+
+        Returns a list of (task_name, fire_time) to start now, and schedules each
+        task's next occurrence after now.
+        """
+        if self.catchup == CATCHUP_SKIP:
+            window = MISSED_GRACE
+        else:
+            window = self.catchup_window
+
+        fires = []
+        for task_name, fire_time in due:
+            schedule = self._schedule(task_name)
+            start = max(fire_time, now - window)
+            missed = schedule.between(start, now)
+            if fire_time == start and (not missed or missed[0] != fire_time):
+                missed.insert(0, fire_time)
+            if self.catchup == CATCHUP_ALL:
+                fires.extend((task_name, when) for when in missed)
+            elif missed:
+                fires.append((task_name, missed[-1]))
+
+            next_run = schedule.next_after(now)
+            if next_run:
+                self.queue.schedule(task_name, next_run)
+        return fires
+
+    async def reconcile(self):
+        pending = await self.run.get_runs(status=Status.Pending)
+        running = await self.run.get_runs(status=Status.Running)
+        pending = [run for run in pending if self.owns(run.task)]
+        running = [run for run in running if self.owns(run.task)]
+        self.log(
+            f"{datetime.datetime.utcnow()}: pending={len(pending)} running={len(running)}"
+        )
+        await self.run.update_statuses(running + pending, update_logs=True)
+        # runs can also finish in other processes (e.g. stopped from the web app)
+        if self.is_leader:
+            await self.run.expire_claims()
+            await self.run.drain_queue()
+
+    async def fire_due(self, now):
+        due = self.queue.pop_due(now)
+        if not due:
+            return
+        fired = set()
+        for task_name, fire_time in self.plan_fires(due, now):
+            next_run = self.queue.get(task_name)
+            self.last_fired[task_name] = fire_time.isoformat()
+            if not await self.storage.claim_fire(task_name, fire_time.isoformat()):
+                self.log(f"{task_name}: {fire_time} already fired by another beat")
+                continue
+            task = await self.storage.get_task(task_name)
+            if task_name in fired:
+                # the rest of a task's missed fires run one after another
+                run = await self.run.queue_task(task)
+                msg = f"queued {task_name}: {run}.  next run at {next_run}"
+            else:
+                fired.add(task_name)
+                try:
+                    run = await self.run.run_task(task)
+                    msg = f"started {task_name}: {run}.  next run at {next_run}"
+                except AlreadyRunning:
+                    msg = f"{task_name}: already running.  next run at {next_run}"
+            self.log(msg)
+
+        await self.storage.save_schedule(
+            [self._entry(task_name) for task_name, _ in due]
+        )
 
 
 async def run_service():
@@ -98,50 +396,62 @@ async def run_service():
         socket.send_string(msg)
         print(msg)
 
-    next_run_list = {}
-    for task in await bobsled.storage.get_tasks():
-        if not task.enabled:
-            continue
-        next_run = next_run_for_task(task)
-        if next_run:
-            next_run_list[task.name] = next_run
-            _log(f"{task.name} next run at {next_run}")
+    beat = Beat(
+        bobsled.storage,
+        bobsled.run,
+        _log,
+        catchup=os.environ.get("BOBSLED_BEAT_CATCHUP", CATCHUP_ONCE),
+        catchup_window=datetime.timedelta(
+            minutes=int(os.environ.get("BOBSLED_BEAT_CATCHUP_WINDOW_MINUTES", "60"))
+        ),
+        spread=datetime.timedelta(
+            minutes=int(os.environ.get("BOBSLED_BEAT_SPREAD_MINUTES", "0"))
+        ),
+        member_id=os.environ.get("BOBSLED_BEAT_MEMBER_ID"),
+    )
+    utcnow = datetime.datetime.utcnow()
+    await beat.sync_members(utcnow)
+    await beat.load_tasks(await bobsled.storage.get_tasks(), utcnow)
+    # completions are pushed where the runner supports it, reconcile is the fallback
+    bobsled.run.watch_events(accept=beat.owns)
+
+    histogram = beat.start_histogram(utcnow, utcnow + datetime.timedelta(days=1))
+    if histogram:
+        peak, n_runs = histogram.most_common(1)[0]
+        _log(f"busiest minute in the next day: {n_runs} runs start at {peak}")
+    next_reconcile = utcnow
+    next_archive = utcnow
 
     while True:
-        pending = await bobsled.run.get_runs(status=Status.Pending)
-        running = await bobsled.run.get_runs(status=Status.Running)
         utcnow = datetime.datetime.utcnow()
 
-        _log(f"{utcnow}: pending={len(pending)} running={len(running)}")
+        if utcnow >= next_reconcile:
+            if utcnow > next_task_update:
+                _log("updating config...")
+                await beat.load_tasks(await bobsled.refresh_config(), utcnow)
+                next_task_update = utcnow + datetime.timedelta(
+                    minutes=UPDATE_CONFIG_MINS
+                )
+                _log(f"updated tasks, will run again at {next_task_update}")
+            await beat.sync_members(utcnow)
+            await beat.reconcile()
+            if beat.is_leader and utcnow >= next_archive:
+                n = await bobsled.archive.archive_expired(utcnow, ARCHIVE_BATCH)
+                if n:
+                    _log(f"archived {n} runs")
+                if n < ARCHIVE_BATCH:
+                    next_archive = utcnow + datetime.timedelta(minutes=ARCHIVE_MINS)
+            next_reconcile = utcnow + datetime.timedelta(seconds=RECONCILE_SECONDS)
 
-        if utcnow > next_task_update:
-            _log("updating config...")
-            await bobsled.refresh_config()
-            next_task_update = utcnow + datetime.timedelta(minutes=UPDATE_CONFIG_MINS)
-            _log(f"updated tasks, will run again at {next_task_update}")
-
-        # parallel updates from all running tasks
-        await asyncio.gather(
-            *[
-                bobsled.run.update_status(run.uuid, update_logs=True)
-                for run in running + pending
-            ]
-        )
-
-        # TODO: could improve by basing next run time on last run instead of using utcnow
-        for task_name, next_run in next_run_list.items():
-            if next_run <= utcnow:
-                # update next run time
-                next_run_list[task_name] = next_run_for_task(task)
-                try:
-                    task = await bobsled.storage.get_task(task_name)
-                    run = await bobsled.run.run_task(task)
-                    msg = f"started {task_name}: {run}.  next run at {next_run_list[task_name]}"
-                except AlreadyRunning:
-                    msg = f"{task_name}: already running.  next run at {next_run_list[task_name]}"
-                _log(msg)
+        await beat.fire_due(utcnow)
 
-        await asyncio.sleep(60)
+        # sleep until the earliest fire or the next reconciliation, whichever is first
+        wake_at = next_reconcile
+        next_fire = beat.queue.peek()
+        if next_fire and next_fire < wake_at:
+            wake_at = next_fire
+        delay = (wake_at - datetime.datetime.utcnow()).total_seconds()
+        await asyncio.sleep(max(delay, 0))
 
 
 if __name__ == "__main__":
@@ -1,6 +1,8 @@
 import os
 import asyncio
 from bobsled import storages, runners, callbacks
+from bobsled.archive import RunArchive
+from bobsled.base import AdmissionPolicy
 from bobsled.environment import EnvironmentProvider
 from bobsled.tasks import TaskProvider
 from bobsled.utils import get_env_config, load_args
@@ -29,10 +31,12 @@ class Bobsled:
         self.storage = StorageCls(**storage_args)
         self.env = EnvironmentProvider(**env_args)
         self.tasks = TaskProvider(storage=self.storage, **task_args)
+        self.archive = RunArchive(storage=self.storage, **load_args(RunArchive))
         self.run = RunCls(
             storage=self.storage,
             environment=self.env,
             callbacks=callback_classes,
+            admission=AdmissionPolicy(**load_args(AdmissionPolicy)),
             **run_args,
         )
 
@@ -46,9 +50,15 @@ class Bobsled:
             self.run.initialize(tasks)
 
     async def refresh_config(self):
-        await asyncio.gather(self.tasks.update_tasks(), self.env.update_environments())
+        changes, changed_envs = await asyncio.gather(
+            self.tasks.update_tasks(), self.env.update_environments()
+        )
         tasks = await self.storage.get_tasks()
-        self.run.initialize(tasks)
+        # only tasks whose definition or environment changed need to be set up again
+        updated = set(changes.updated)
+        self.run.initialize(
+            [t for t in tasks if t.name in updated or t.environment in changed_envs]
+        )
         return tasks
 
 
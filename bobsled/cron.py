@@ -0,0 +1,378 @@
+import bisect
+import hashlib
+import calendar
+import datetime
+import functools
+import collections
+
+# a schedule that can't fire within this many years is treated as never firing
+# (28 years is the full cycle of the Gregorian weekday/leap-year combination)
+MAX_SEARCH_YEARS = 28
+
+
+MONTH_NAMES = {
+    name: num
+    for num, name in enumerate(
+        "JAN FEB MAR APR MAY JUN JUL AUG SEP OCT NOV DEC".split(), start=1
+    )
+}
+# weekdays use datetime.weekday() numbering, Monday is 0
+WEEKDAY_NAMES = {
+    name: num for num, name in enumerate("MON TUE WED THU FRI SAT SUN".split())
+}
+MACROS = {
+    "@yearly": "0 0 1 1 ?",
+    "@annually": "0 0 1 1 ?",
+    "@monthly": "0 0 1 * ?",
+    "@weekly": "0 0 ? * 6",
+    "@daily": "0 0 * * ?",
+    "@midnight": "0 0 * * ?",
+    "@hourly": "0 * * * ?",
+}
+
+
+def _parse_cron_value(value, names):
+    value = names.get(value.upper(), value)
+    if isinstance(value, int):
+        return value
+    if not value.isdigit():
+        raise ValueError(value)
+    return int(value)
+
+
+def parse_cron_segment(segment, star_equals, names=None):
+    """
+    Parse one field of a cron expression into a sorted list of values.
+
+    star_equals is the full range of the field, and is also used to bound ranges
+    and steps.  Supports *, single values, a-b ranges, */n, a/n and a-b/n steps,
+    and comma-separated lists mixing any of those.
+    """
+    names = names or {}
+    low, high = star_equals[0], star_equals[-1]
+    values = set()
+    for part in segment.split(","):
+        if "/" in part:
+            part, step = part.split("/")
+            step = int(step)
+            if step < 1:
+                raise ValueError(segment)
+        else:
+            step = None
+
+        if part in ("*", "?"):
+            start, end = low, high
+        elif "-" in part:
+            start, end = part.split("-")
+            start = _parse_cron_value(start, names)
+            end = _parse_cron_value(end, names)
+        else:
+            start = end = _parse_cron_value(part, names)
+            if step:
+                # a/n means every n starting at a
+                end = high
+
+        if not low <= start <= end <= high:
+            raise ValueError(segment)
+        values.update(range(start, end + 1, step or 1))
+    return sorted(values)
+
+
+class CronSchedule:
+    """
+    A cron expression parsed once into sorted values for each field.
+
+    Lookups jump field by field (month, day, hour, minute) using bisection on the
+    sorted values instead of trying every minute of the year.
+    """
+
+    def __init__(self, cronstr):
+        self.cron = cronstr
+        cronstr = MACROS.get(cronstr.strip().lower(), cronstr)
+        try:
+            minute, hour, day, month, dow = cronstr.split()
+        except ValueError:
+            raise ValueError(f"cron expression must have five fields: {cronstr}")
+        self.minutes = tuple(parse_cron_segment(minute, list(range(60))))
+        self.hours = tuple(parse_cron_segment(hour, list(range(24))))
+        self.days = tuple(parse_cron_segment(day, list(range(1, 32))))
+        self.months = tuple(parse_cron_segment(month, list(range(1, 13)), MONTH_NAMES))
+        if dow in ("?", "*"):
+            self.weekdays = None
+        else:
+            self.weekdays = frozenset(
+                parse_cron_segment(dow, list(range(7)), WEEKDAY_NAMES)
+            )
+        self._month_set = frozenset(self.months)
+        self._day_set = frozenset(self.days)
+
+    def __repr__(self):
+        return f"CronSchedule({self.cron!r})"
+
+    def _next_day(self, year, month, day):
+        """first matching day >= day in the given month, or None"""
+        last_day = calendar.monthrange(year, month)[1]
+        for candidate in self.days[bisect.bisect_left(self.days, day) :]:
+            if candidate > last_day:
+                break
+            if (
+                self.weekdays is None
+                or calendar.weekday(year, month, candidate) in self.weekdays
+            ):
+                return candidate
+        return None
+
+    def next_after(self, after):
+        """
+        Return the first fire time strictly after the given datetime.
+
+        Returns None if the expression can never fire (e.g. February 30th).
+        """
+        start = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        year, month, day = start.year, start.month, start.day
+        hour, minute = start.hour, start.minute
+
+        while year <= start.year + MAX_SEARCH_YEARS:
+            if month not in self._month_set:
+                idx = bisect.bisect_left(self.months, month)
+                if idx == len(self.months):
+                    year += 1
+                    month = self.months[0]
+                else:
+                    month = self.months[idx]
+                day, hour, minute = 1, 0, 0
+
+            next_day = self._next_day(year, month, day)
+            if next_day is None:
+                month += 1
+                day, hour, minute = 1, 0, 0
+                continue
+            if next_day != day:
+                day, hour, minute = next_day, 0, 0
+
+            idx = bisect.bisect_left(self.hours, hour)
+            if idx == len(self.hours):
+                day += 1
+                hour, minute = 0, 0
+                continue
+            if self.hours[idx] != hour:
+                hour, minute = self.hours[idx], 0
+
+            idx = bisect.bisect_left(self.minutes, minute)
+            if idx == len(self.minutes):
+                hour += 1
+                minute = 0
+                continue
+
+            return datetime.datetime(
+                year, month, day, hour, self.minutes[idx], tzinfo=after.tzinfo
+            )
+
+        return None
+
+    def next_n(self, after, n):
+        """Return a list of the next n fire times after the given datetime."""
+        times = []
+        for _ in range(n):
+            after = self.next_after(after)
+            if after is None:
+                break
+            times.append(after)
+        return times
+
+    def between(self, start, end):
+        """Return all fire times from start to end, inclusive."""
+        times = []
+        day = start.date()
+        while day <= end.date():
+            if day.month not in self._month_set:
+                # skip the rest of the month
+                day = day.replace(day=1) + datetime.timedelta(days=32)
+                day = day.replace(day=1)
+                continue
+            if day.day in self._day_set and (
+                self.weekdays is None or day.weekday() in self.weekdays
+            ):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        fire_time = datetime.datetime(
+                            day.year,
+                            day.month,
+                            day.day,
+                            hour,
+                            minute,
+                            tzinfo=start.tzinfo,
+                        )
+                        if start <= fire_time <= end:
+                            times.append(fire_time)
+            day += datetime.timedelta(days=1)
+        return times
+
+
+class MergedSchedule:
+    """Several cron expressions (e.g. a task's triggers) treated as one schedule."""
+
+    def __init__(self, schedules):
+        self.schedules = schedules
+
+    def __repr__(self):
+        return f"MergedSchedule({self.schedules!r})"
+
+    def next_after(self, after):
+        times = [s.next_after(after) for s in self.schedules]
+        times = [t for t in times if t]
+        return min(times) if times else None
+
+    def next_n(self, after, n):
+        times = []
+        for _ in range(n):
+            after = self.next_after(after)
+            if after is None:
+                break
+            times.append(after)
+        return times
+
+    def between(self, start, end):
+        times = set()
+        for schedule in self.schedules:
+            times.update(schedule.between(start, end))
+        return sorted(times)
+
+
+class OffsetSchedule:
+    """A schedule with every fire time shifted later by a fixed offset."""
+
+    def __init__(self, schedule, offset):
+        self.schedule = schedule
+        self.offset = offset
+
+    def __repr__(self):
+        return f"OffsetSchedule({self.schedule!r}, {self.offset!r})"
+
+    def next_after(self, after):
+        fire_time = self.schedule.next_after(after - self.offset)
+        if fire_time:
+            return fire_time + self.offset
+
+    def next_n(self, after, n):
+        return [t + self.offset for t in self.schedule.next_n(after - self.offset, n)]
+
+    def between(self, start, end):
+        return [
+            t + self.offset
+            for t in self.schedule.between(start - self.offset, end - self.offset)
+        ]
+
+
+def spread_offset(task_name, window):
+    """
+    A stable offset within window for the task, derived from a hash of its name.
+
+    Used to spread out tasks that share a cron expression.
+    """
+    seconds = int(window.total_seconds())
+    if seconds <= 0:
+        return datetime.timedelta(0)
+    digest = hashlib.sha1(task_name.encode()).hexdigest()
+    return datetime.timedelta(seconds=int(digest, 16) % seconds)
+
+
+def task_schedule(task_name, cronstr, spread=None):
+    """The compiled schedule for a task, offset within spread if given."""
+    schedule = compile_cron(cronstr)
+    if spread:
+        schedule = OffsetSchedule(schedule, spread_offset(task_name, spread))
+    return schedule
+
+
+def start_histogram(times):
+    """Count fire times per minute, returns a Counter keyed on the minute."""
+    return collections.Counter(t.replace(second=0, microsecond=0) for t in times)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_cron(cronstr):
+    """
+    Compile a cron expression, or several separated by semicolons, into a schedule.
+    """
+    crons = [c.strip() for c in cronstr.split(";") if c.strip()]
+    if len(crons) == 1:
+        return CronSchedule(crons[0])
+    return MergedSchedule([compile_cron(c) for c in crons])
+
+
+def task_cron(task):
+    """All of a task's triggers as a single string for compile_cron."""
+    return "; ".join(trigger.cron for trigger in task.triggers)
+
+
+def next_cron(cronstr, after=None):
+    if not after:
+        after = datetime.datetime.utcnow()
+    return compile_cron(cronstr).next_after(after)
+
+
+def next_run_for_task(task, after=None):
+    if task.triggers:
+        return next_cron(task_cron(task), after)
+
+
+def _group_by_cron(tasks):
+    by_cron = {}
+    for task in tasks:
+        if task.triggers:
+            by_cron.setdefault(task_cron(task), []).append(task.name)
+    return by_cron
+
+
+def next_runs_for_tasks(tasks, after=None, spread=None):
+    """
+    Compute the next run for many tasks in one pass.
+
+    Tasks that share a cron expression (the common case) share one computation,
+    unless spread is given, in which case each task is offset within it.
+
+    Returns a dict mapping task names to their next run, tasks without triggers
+    are omitted.
+    """
+    if not after:
+        after = datetime.datetime.utcnow()
+    next_runs = {}
+    for cronstr, names in _group_by_cron(tasks).items():
+        if spread:
+            for name in names:
+                next_run = task_schedule(name, cronstr, spread).next_after(after)
+                if next_run:
+                    next_runs[name] = next_run
+            continue
+        next_run = compile_cron(cronstr).next_after(after)
+        if next_run:
+            for name in names:
+                next_runs[name] = next_run
+    return next_runs
+
+
+def fire_times(tasks, start, end, spread=None):
+    """
+    Compute every fire time between start and end (inclusive) for many tasks.
+
+    Each distinct schedule is expanded once, a day at a time, and shared between
+    the tasks that use it (shifted by each task's offset if spread is given).
+
+    Returns a dict mapping task names to sorted lists of fire times.
+    """
+    times_by_task = {}
+    for cronstr, names in _group_by_cron(tasks).items():
+        if spread:
+            # expand once over a widened window, then shift per task
+            offsets = {name: spread_offset(name, spread) for name in names}
+            times = compile_cron(cronstr).between(start - spread, end)
+            for name, offset in offsets.items():
+                times_by_task[name] = [
+                    t + offset for t in times if start <= t + offset <= end
+                ]
+            continue
+        times = compile_cron(cronstr).between(start, end)
+        for name in names:
+            times_by_task[name] = times
+    return times_by_task
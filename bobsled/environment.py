@@ -1,3 +1,4 @@
+import re
 import boto3
 from .base import Environment
 from .utils import load_github_or_local_yaml
@@ -20,6 +21,104 @@ def paramstore_loader(varname):
     return resp["Parameter"]["Value"]
 
 
+def _trie_pattern(words):
+    """
+    Build a regex matching any of words, sharing common prefixes.
+
+    At each position only one branch per character is tried and longer words
+    are preferred, so a secret containing another secret is matched as a whole.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def build(node):
+        alternatives = [
+            re.escape(ch) + build(child) for ch, child in node.items() if ch
+        ]
+        if not alternatives:
+            return ""
+        if len(alternatives) == 1 and "" not in node:
+            return alternatives[0]
+        pattern = "(?:" + "|".join(alternatives) + ")"
+        # a word ends here, but try to continue matching a longer one first
+        return pattern + "?" if "" in node else pattern
+
+    return re.compile(build(trie))
+
+
+class SecretMasker:
+    """
+    Replaces every secret in a string, longer secrets first.
+
+    replacements maps secret values to the text that replaces them.  Text of
+    at least PATTERN_MIN_LENGTH characters is masked in a single regex pass,
+    below that one str.replace per secret is faster.
+    """
+
+    # measured with scripts/benchmark_masking.py, the single pass only wins
+    # on logs of tens of megabytes
+    PATTERN_MIN_LENGTH = 20 * 1024 * 1024
+
+    def __init__(self, replacements):
+        self.replacements = replacements
+        self.longest = max((len(secret) for secret in replacements), default=0)
+        self.pattern = _trie_pattern(replacements) if replacements else None
+        self.by_length = sorted(replacements, key=len, reverse=True)
+
+    def mask(self, string):
+        if not self.pattern:
+            return string
+        if len(string) < self.PATTERN_MIN_LENGTH:
+            for secret in self.by_length:
+                string = string.replace(secret, self.replacements[secret])
+            return string
+        return self.pattern.sub(lambda m: self.replacements[m.group()], string)
+
+    def stream(self):
+        return StreamMasker(self)
+
+
+class StreamMasker:
+    """
+    Masks text arriving in chunks, a secret split between chunks is still masked.
+
+    The end of each chunk that could be the start of a secret is held back until
+    the next chunk arrives, call flush() once the stream ends to get the rest.
+    """
+
+    def __init__(self, masker):
+        self.masker = masker
+        self.pending = ""
+
+    def feed(self, chunk):
+        if not self.masker.pattern:
+            return chunk
+        text = self.pending + chunk
+        # a match starting before here can't be cut short by the next chunk
+        safe = len(text) - self.masker.longest + 1
+        output = []
+        pos = 0
+        for match in self.masker.pattern.finditer(text):
+            if match.start() >= safe:
+                break
+            output.append(text[pos : match.start()])
+            output.append(self.masker.replacements[match.group()])
+            pos = match.end()
+        keep = max(pos, safe)
+        output.append(text[pos:keep])
+        self.pending = text[keep:]
+        return "".join(output)
+
+    def flush(self):
+        text = self.masker.mask(self.pending)
+        self.pending = ""
+        return text
+
+
 class EnvironmentProvider:
     def __init__(
         self,
@@ -35,6 +134,7 @@ class EnvironmentProvider:
         self.github_repo = BOBSLED_CONFIG_GITHUB_REPO
         self.github_api_key = BOBSLED_GITHUB_API_KEY
         self.environments = {}
+        self.masker = SecretMasker({})
 
         if not self.filename and not self.dirname:
             raise EnvironmentError(
@@ -42,14 +142,17 @@ class EnvironmentProvider:
             )
 
     def mask_variables(self, string):
-        for env_name in self.get_environment_names():
-            env = self.get_environment(env_name)
+        return self.masker.mask(string)
+
+    def _compile_masker(self):
+        replacements = {}
+        for env_name, env in self.environments.items():
             for var, value in env.values.items():
-                if var not in env.unmasked:
-                    string = string.replace(
-                        str(value), f"**{env_name.upper()}/{var.upper()}**"
-                    )
-        return string
+                value = str(value)
+                # the first environment to define a value names it
+                if var not in env.unmasked and value and value not in replacements:
+                    replacements[value] = f"**{env_name.upper()}/{var.upper()}**"
+        self.masker = SecretMasker(replacements)
 
     def get_environment_names(self):
         return list(self.environments.keys())
@@ -58,6 +161,7 @@ class EnvironmentProvider:
         return self.environments[name]
 
     async def update_environments(self):
+        """Reload environments, returns the names of any that were added or changed."""
         data = load_github_or_local_yaml(
             self.filename,
             self.dirname,
@@ -66,6 +170,7 @@ class EnvironmentProvider:
             self.github_api_key,
         )
 
+        changed = []
         for name, envdef in data.items():
             values = {}
             unmasked = []
@@ -82,4 +187,9 @@ class EnvironmentProvider:
                     )
                 if not env_var.get("masked", True):
                     unmasked.append(env_var["variable"])
-            self.environments[name] = Environment(name, values, unmasked)
+            env = Environment(name, values, unmasked)
+            if self.environments.get(name) != env:
+                changed.append(name)
+            self.environments[name] = env
+        self._compile_masker()
+        return changed
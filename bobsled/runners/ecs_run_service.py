@@ -1,8 +1,12 @@
+import asyncio
 import datetime
 import boto3
 from botocore.exceptions import ClientError
 from ..base import RunService, Status
 
+# the most tasks describe_tasks accepts in one call
+DESCRIBE_TASKS_BATCH = 100
+
 
 class ECSRunService(RunService):
 
@@ -13,6 +17,7 @@ class ECSRunService(RunService):
         storage,
         environment,
         callbacks=None,
+        admission=None,
         *,
         BOBSLED_ECS_CLUSTER,
         BOBSLED_SUBNET_ID,
@@ -23,12 +28,18 @@ class ECSRunService(RunService):
         self.storage = storage
         self.environment = environment
         self.callbacks = callbacks or []
+        if admission:
+            self.admission = admission
         self.cluster_name = BOBSLED_ECS_CLUSTER
         self.subnet_id = BOBSLED_SUBNET_ID
         self.security_group_id = BOBSLED_SECURITY_GROUP_ID
         self.log_group = BOBSLED_LOG_GROUP
         self.role_arn = BOBSLED_ROLE_ARN
         self.ecs = boto3.client("ecs")
+        # masking state for runs whose logs are being streamed, by run uuid
+        self._maskers = {}
+        self._drain_lock = asyncio.Lock()
+        self._flights = {}
 
         self.cluster_arn = self.ecs.describe_clusters(clusters=[self.cluster_name])[
             "clusters"
@@ -150,47 +161,64 @@ class ECSRunService(RunService):
         )
         return {"task_arn": resp["tasks"][0]["taskArn"]}
 
-    async def update_status(self, run_id, update_logs=False):
-        run = await self.storage.get_run(run_id)
-
-        if run.status.is_terminal():
-            return run
-
-        # note: what ECS calls a task, we call a run
-        arn = run.run_info["task_arn"]
-        resp = self.ecs.describe_tasks(cluster=self.cluster_name, tasks=[arn])
-
-        if resp["failures"]:
-            if resp["failures"][0]["reason"] == "MISSING":
-                run.exit_code = -999
-                run.end = datetime.datetime.utcnow().isoformat()
-                run.status = Status.Missing
-                run.logs = self.get_logs(run)
-                await self.storage.save_run(run)
-                return run
-                # TODO: improve handling, should we call callbacks on missing?
-            raise ValueError(f"unexpected status: {resp['failures']}")
+    async def _update_statuses(self, runs, update_logs=False):
+        """
+        Update many runs with one describe_tasks call per DESCRIBE_TASKS_BATCH runs.
 
-        result = resp["tasks"][0]
+        Note: what ECS calls a task, we call a run.
+        """
+        results = {}
+        failures = {}
+        for i in range(0, len(runs), DESCRIBE_TASKS_BATCH):
+            arns = [
+                run.run_info["task_arn"] for run in runs[i : i + DESCRIBE_TASKS_BATCH]
+            ]
+            resp = self.ecs.describe_tasks(cluster=self.cluster_name, tasks=arns)
+            results.update((result["taskArn"], result) for result in resp["tasks"])
+            failures.update((failure["arn"], failure) for failure in resp["failures"])
+
+        for run in runs:
+            arn = run.run_info["task_arn"]
+            if arn in results:
+                await self._apply_result(run, results[arn], update_logs)
+            elif failures.get(arn, {}).get("reason") == "MISSING":
+                await self._apply_missing(run)
+            else:
+                # leave it for the next pass rather than failing the whole batch
+                print(f"unexpected status for {run.uuid}: {failures.get(arn)}")
+        return runs
+
+    async def _apply_missing(self, run):
+        run.exit_code = -999
+        run.end = datetime.datetime.utcnow().isoformat()
+        run.status = Status.Missing
+        await self._save_final_logs(run)
+        await self.storage.save_run(run)
+        # TODO: improve handling, should we call callbacks on missing?
+
+    async def _apply_result(self, run, result, update_logs):
         if result["lastStatus"] == "STOPPED":
             run.end = datetime.datetime.utcnow().isoformat()
-            run.logs = self.get_logs(run)
+            logs = None
             try:
                 run.exit_code = result["containers"][0]["exitCode"]
             except KeyError:
                 run.exit_code = -400
-                run.logs = result["containers"][0].get("reason")
-                if not run.logs:
-                    run.logs = "No exit code or reason: " + repr(
-                        result["containers"][0]
-                    )
+                logs = result["containers"][0].get("reason")
+                if not logs:
+                    logs = "No exit code or reason: " + repr(result["containers"][0])
+            if logs:
+                self._maskers.pop(run.uuid, None)
+                await self._save_logs(run, logs, replace=True)
+            else:
+                await self._save_final_logs(run)
             run.status = Status.Error if run.exit_code else Status.Success
             await self._save_and_followup(run)
         elif (
             run.run_info["timeout_at"]
             and datetime.datetime.utcnow().isoformat() > run.run_info["timeout_at"]
         ):
-            run.logs = self.get_logs(run)
+            await self._save_final_logs(run)
             self.stop(run)
             run.status = Status.TimedOut
             await self._save_and_followup(run)
@@ -198,48 +226,83 @@ class ECSRunService(RunService):
         elif result["lastStatus"] == "RUNNING":
             if run.status != Status.Running:
                 run.status = Status.Running
-                run.logs = self.get_logs(run)
+                await self.update_logs(run)
                 await self._save_and_followup(run)
             elif update_logs:
-                run.logs = self.get_logs(run)
+                await self.update_logs(run)
                 await self.storage.save_run(run)
         elif result["lastStatus"] in ("PENDING", "PROVISIONING"):
             if run.status != Status.Pending:
                 run.status = Status.Pending
                 await self._save_and_followup(run)
 
-        return run
-
     def stop(self, run):
         self.ecs.stop_task(cluster=self.cluster_name, task=run.run_info["task_arn"])
 
+    async def _save_final_logs(self, run):
+        self._maskers.pop(run.uuid, None)
+        await self._save_logs(run, self.get_logs(run))
+
     def get_logs(self, run):
         return self.environment.mask_variables(
             "\n".join(line["message"] for line in self.iter_logs(run))
         )
 
+    async def update_logs(self, run):
+        """
+        Append the log lines written since the last update to the run's logs.
+
+        The forward token and line count are kept in run_info so that each update
+        only fetches new events, get_logs does a full fetch once the run is over.
+        """
+        next_token = run.run_info.get("log_token")
+        lines = []
+        try:
+            for events, next_token in self._log_pages(run, next_token):
+                lines.extend(event["message"] for event in events)
+        except ClientError:
+            # the stream isn't created until the container starts
+            pass
+        if lines:
+            new_logs = "\n".join(lines)
+            if run.run_info.get("log_lines"):
+                new_logs = "\n" + new_logs
+            # output that might be the start of a secret is held back until the
+            # next update, the final full fetch picks up anything still held
+            masker = self._maskers.setdefault(
+                run.uuid, self.environment.masker.stream()
+            )
+            await self._append_logs(run, masker.feed(new_logs))
+        if next_token:
+            run.run_info["log_token"] = next_token
+        run.run_info["log_lines"] = run.run_info.get("log_lines", 0) + len(lines)
+
     def iter_logs(self, run):
+        try:
+            for events, _ in self._log_pages(run):
+                yield from events
+        except ClientError:
+            yield {"message": "no logs"}
+
+    def _log_pages(self, run, next_token=None):
+        """yield (events, forward token) for each page of the log stream after next_token"""
         logs = boto3.client("logs")
         arn_uuid = run.run_info["task_arn"].split("/")[-1]
         log_arn = f"{run.task.lower()}/{run.task}/{arn_uuid}"
 
-        next_token = None
-
         while True:
             extra = {"nextToken": next_token} if next_token else {}
-            try:
-                events = logs.get_log_events(
-                    logGroupName=self.log_group, logStreamName=log_arn, **extra
-                )
-            except ClientError:
-                yield {"message": "no logs"}
-                break
-            next_token = events["nextForwardToken"]
-
+            events = logs.get_log_events(
+                logGroupName=self.log_group,
+                logStreamName=log_arn,
+                startFromHead=True,
+                **extra,
+            )
             if not events["events"]:
                 break
+            next_token = events["nextForwardToken"]
 
-            yield from events["events"]
+            yield events["events"], next_token
 
             if not next_token:
                 break
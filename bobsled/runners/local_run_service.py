@@ -1,17 +1,31 @@
+import time
+import asyncio
 import datetime
+import threading
 import docker
 from ..base import RunService, Status
 
+# containers started by bobsled carry this label, set to the task name
+TASK_LABEL = "bobsled.task"
+EVENTS_RECONNECT_SECONDS = 5
+
 
 class LocalRunService(RunService):
 
     STARTING_STATUS = Status.Running
 
-    def __init__(self, storage, environment, callbacks=None):
+    def __init__(self, storage, environment, callbacks=None, admission=None):
         self.client = docker.from_env()
         self.storage = storage
         self.environment = environment
         self.callbacks = callbacks or []
+        if admission:
+            self.admission = admission
+        self._watcher = None
+        self._events = None
+        self._accept = None
+        self._drain_lock = asyncio.Lock()
+        self._flights = {}
 
     def _get_container(self, run):
         if run.status == Status.Running:
@@ -41,6 +55,7 @@ class LocalRunService(RunService):
             task.entrypoint if task.entrypoint else None,
             detach=True,
             environment=env,
+            labels={TASK_LABEL: task.name},
         )
         return {"container_id": container.id}
 
@@ -51,12 +66,53 @@ class LocalRunService(RunService):
             return
         container.remove(force=True)
 
-    async def update_status(self, run_id, update_logs=False):
-        run = await self.storage.get_run(run_id)
+    def watch_events(self, accept=None):
+        """
+        Finish runs as soon as docker reports that their container died.
+
+        Events are read on a background thread and handled on the current event
+        loop, polling update_status remains as a fallback for missed events.
+        """
+        if self._watcher:
+            return
+        self._accept = accept
+        self._watcher = threading.Thread(
+            target=self._read_events, args=(asyncio.get_event_loop(),), daemon=True
+        )
+        self._watcher.start()
 
-        if run.status.is_terminal():
-            return run
+    def stop_watching(self):
+        self._watcher = None
+        if self._events:
+            self._events.close()
 
+    def _read_events(self, loop):
+        while self._watcher:
+            try:
+                self._events = self.client.events(
+                    decode=True,
+                    filters={"type": "container", "label": TASK_LABEL, "event": "die"},
+                )
+                for event in self._events:
+                    asyncio.run_coroutine_threadsafe(self.handle_event(event), loop)
+            except Exception as e:
+                # docker restarting, connection dropped, etc.
+                print("docker events error", e)
+            if self._watcher:
+                time.sleep(EVENTS_RECONNECT_SECONDS)
+
+    async def handle_event(self, event):
+        task_name = event["Actor"]["Attributes"].get(TASK_LABEL)
+        if self._accept and not self._accept(task_name):
+            return
+        for run in await self.storage.get_runs(
+            status=Status.Running, task_name=task_name
+        ):
+            if run.run_info.get("container_id") == event["id"]:
+                # the run finished, so anything reconciled before now is out of date
+                await self.update_status(run.uuid, update_logs=True, max_age=0)
+
+    async def _update_status(self, run, update_logs=False):
         container = self._get_container(run)
         if not container:
             run.status = Status.Missing
@@ -69,9 +125,13 @@ class LocalRunService(RunService):
             else:
                 run.status = Status.Success
 
-            run.logs = self.environment.mask_variables(container.logs().decode())
+            await self._save_logs(
+                run, self.environment.mask_variables(container.logs().decode())
+            )
             run.end = datetime.datetime.utcnow().isoformat()
             run.exit_code = resp["StatusCode"]
+            if container.attrs["State"].get("OOMKilled"):
+                run.run_info["oom_killed"] = True
             await self._save_and_followup(run)
             container.remove()
 
@@ -80,12 +140,16 @@ class LocalRunService(RunService):
                 run.run_info["timeout_at"]
                 and datetime.datetime.utcnow().isoformat() > run.run_info["timeout_at"]
             ):
-                run.logs = self.environment.mask_variables(container.logs().decode())
+                await self._save_logs(
+                    run, self.environment.mask_variables(container.logs().decode())
+                )
                 container.remove(force=True)
                 run.status = Status.TimedOut
                 await self._save_and_followup(run)
 
             elif update_logs:
-                run.logs = self.environment.mask_variables(container.logs().decode())
+                await self._save_logs(
+                    run, self.environment.mask_variables(container.logs().decode())
+                )
                 await self.storage.save_run(run)
         return run
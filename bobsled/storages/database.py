@@ -1,10 +1,32 @@
 import json
+import time
+import functools
+import contextlib
 import attr
 import sqlalchemy
 from databases import Database
-from ..base import Run, Status, Task, Trigger, User
-from ..utils import hash_password, verify_password
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from ..base import (
+    ACTIVE_STATUSES,
+    FAILED_STATUSES,
+    Run,
+    ScheduleEntry,
+    Status,
+    Task,
+    Trigger,
+    User,
+    diff_tasks,
+)
+from ..utils import compress_logs, decompress_logs, hash_password, verify_password
+
 
+# bumped by every write the dashboard shows (runs and tasks), see get_change_version
+Changes = sqlalchemy.Sequence("bobsled_change_seq")
+# how often the task cache checks whether another process changed the tasks
+TASK_VERSION_CHECK_SECONDS = 5
+# rows per upsert statement, asyncpg allows at most 32767 parameters per query
+UPSERT_BATCH = 500
 
 metadata = sqlalchemy.MetaData()
 Tasks = sqlalchemy.Table(
@@ -22,6 +44,7 @@ Tasks = sqlalchemy.Table(
     sqlalchemy.Column("error_threshold", sqlalchemy.Integer),
     sqlalchemy.Column("triggers", sqlalchemy.JSON()),
     sqlalchemy.Column("next_tasks", sqlalchemy.ARRAY(sqlalchemy.String(length=100))),
+    sqlalchemy.Column("priority", sqlalchemy.Integer, server_default="0"),
 )
 Runs = sqlalchemy.Table(
     "bobsled_run",
@@ -34,9 +57,63 @@ Runs = sqlalchemy.Table(
     sqlalchemy.Column("start", sqlalchemy.String(length=50)),
     sqlalchemy.Column("end", sqlalchemy.String(length=50)),
     sqlalchemy.Column("logs", sqlalchemy.String()),
+    sqlalchemy.Column("logs_compressed", sqlalchemy.LargeBinary()),
     sqlalchemy.Column("exit_code", sqlalchemy.Integer),
     sqlalchemy.Column("run_info_json", sqlalchemy.JSON()),
 )
+# run listings are paged newest first on (start, uuid), so each page is read
+# straight from one of these, and the beat and run service poll active runs,
+# most runs are finished so the partial index stays small
+sqlalchemy.Index("ix_bobsled_run_start_uuid", Runs.c.start, Runs.c.uuid)
+sqlalchemy.Index(
+    "ix_bobsled_run_task_start_uuid", Runs.c.task, Runs.c.start, Runs.c.uuid
+)
+sqlalchemy.Index(
+    "ix_bobsled_run_status_start_uuid", Runs.c.status, Runs.c.start, Runs.c.uuid
+)
+sqlalchemy.Index(
+    "ix_bobsled_run_active",
+    Runs.c.start,
+    postgresql_where=Runs.c.status.in_([s.name for s in ACTIVE_STATUSES]),
+)
+# replaced by the indexes above, dropped from older databases
+OBSOLETE_INDEXES = ["ix_bobsled_run_task_start", "ix_bobsled_run_status"]
+# logs are written as chunks keyed on their character position in the full log,
+# so concurrent writers appending the same output don't duplicate it
+RunLogs = sqlalchemy.Table(
+    "bobsled_run_log",
+    metadata,
+    sqlalchemy.Column("run", sqlalchemy.String(length=50), primary_key=True),
+    sqlalchemy.Column("position", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("text", sqlalchemy.String()),
+)
+Schedule = sqlalchemy.Table(
+    "bobsled_schedule",
+    metadata,
+    sqlalchemy.Column("task", sqlalchemy.String(length=100), primary_key=True),
+    sqlalchemy.Column("cron", sqlalchemy.String(length=100)),
+    sqlalchemy.Column("next_run", sqlalchemy.String(length=50)),
+    sqlalchemy.Column("last_fired", sqlalchemy.String(length=50)),
+)
+BeatMembers = sqlalchemy.Table(
+    "bobsled_beat",
+    metadata,
+    sqlalchemy.Column("member", sqlalchemy.String(length=100), primary_key=True),
+    sqlalchemy.Column("expires_at", sqlalchemy.String(length=50)),
+)
+FireClaims = sqlalchemy.Table(
+    "bobsled_fire_claim",
+    metadata,
+    sqlalchemy.Column("task", sqlalchemy.String(length=100), primary_key=True),
+    sqlalchemy.Column("fire_time", sqlalchemy.String(length=50), primary_key=True),
+)
+# counters bumped whenever what they name changes, e.g. the task list
+Meta = sqlalchemy.Table(
+    "bobsled_meta",
+    metadata,
+    sqlalchemy.Column("key", sqlalchemy.String(length=100), primary_key=True),
+    sqlalchemy.Column("version", sqlalchemy.Integer),
+)
 Users = sqlalchemy.Table(
     "bobsled_user",
     metadata,
@@ -46,6 +123,185 @@ Users = sqlalchemy.Table(
 )
 
 
+async def _upgrade_schema(database):
+    """
+    Create any missing tables, columns and indexes, bringing databases created by
+    older versions up to date.  Safe to run on every start.
+    """
+    dialect = postgresql.dialect()
+    rows = await database.fetch_all(
+        "SELECT table_name, column_name FROM information_schema.columns "
+        "WHERE table_schema = current_schema()"
+    )
+    existing = {}
+    for row in rows:
+        existing.setdefault(row["table_name"], set()).add(row["column_name"])
+    rows = await database.fetch_all(
+        "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema()"
+    )
+    indexes = {row["indexname"] for row in rows}
+    await database.execute(f"CREATE SEQUENCE IF NOT EXISTS {Changes.name}")
+
+    def ddl(element):
+        # databases passes compile arguments the DDL compilers don't accept
+        return str(element.compile(dialect=dialect))
+
+    for table in metadata.sorted_tables:
+        if table.name not in existing:
+            await database.execute(ddl(sqlalchemy.schema.CreateTable(table)))
+        else:
+            for column in table.columns:
+                if column.name not in existing[table.name]:
+                    coltype = column.type.compile(dialect)
+                    alter = f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" {coltype}'
+                    if column.server_default is not None:
+                        alter += f" DEFAULT {column.server_default.arg}"
+                    await database.execute(alter)
+        for index in table.indexes:
+            if index.name not in indexes:
+                await database.execute(ddl(sqlalchemy.schema.CreateIndex(index)))
+    for name in OBSOLETE_INDEXES:
+        if name in indexes:
+            await database.execute(f"DROP INDEX {name}")
+
+
+def _prepare(query, **kwargs):
+    """
+    Compile a query with named bind parameters once, so running it again only
+    binds new values instead of recompiling the whole statement.
+
+    Bind and result column types are kept so values are converted as before.
+    """
+    compiled = query.compile(dialect=postgresql.dialect(paramstyle="named"), **kwargs)
+    statement = sqlalchemy.text(compiled.string).bindparams(
+        *[sqlalchemy.bindparam(name, type_=b.type) for name, b in compiled.binds.items()]
+    )
+    if isinstance(query, sqlalchemy.sql.Select):
+        statement = statement.columns(*query.selected_columns)
+    return statement
+
+
+# the run columns other than the logs
+RUN_COLUMNS = [
+    Runs.c.uuid,
+    Runs.c.task,
+    Runs.c.status,
+    Runs.c.start,
+    Runs.c.end,
+    Runs.c.exit_code,
+    Runs.c.run_info_json,
+]
+RUN_FIELDS = [c.name for c in RUN_COLUMNS] + ["logs"]
+
+GET_RUN = _prepare(Runs.select().where(Runs.c.uuid == sqlalchemy.bindparam("uuid")))
+GET_RUN_NO_LOGS = _prepare(
+    sqlalchemy.select(RUN_COLUMNS).where(Runs.c.uuid == sqlalchemy.bindparam("uuid"))
+)
+GET_RUN_LOGS = _prepare(
+    sqlalchemy.select([Runs.c.uuid, Runs.c.logs, Runs.c.logs_compressed]).where(
+        Runs.c.uuid == sqlalchemy.bindparam("uuid")
+    )
+)
+ADD_RUN = _prepare(Runs.insert(), column_keys=RUN_FIELDS)
+SAVE_RUN = _prepare(
+    Runs.update().where(Runs.c.uuid == sqlalchemy.bindparam("uuid")),
+    column_keys=[name for name in RUN_FIELDS if name not in ("uuid", "logs")],
+)
+# sequence values are visible to other sessions straight away, so the change
+# counter is only bumped once a write has committed, never inside its transaction
+BUMP_CHANGES = sqlalchemy.select([Changes.next_value()])
+
+
+@functools.lru_cache(maxsize=None)
+def _runs_template(statuses, by_task, latest, before=False, since=False, until=False):
+    query = sqlalchemy.select(RUN_COLUMNS).order_by(
+        Runs.c.start.desc(), Runs.c.uuid.desc()
+    )
+    if statuses == ():
+        query = query.where(sqlalchemy.false())
+    elif statuses:
+        # statuses are written into the SQL so the planner can match them against
+        # the partial index, they're Status names so there's nothing to escape
+        query = query.where(
+            Runs.c.status.in_([sqlalchemy.literal_column(f"'{s}'") for s in statuses])
+        )
+    if by_task:
+        query = query.where(Runs.c.task == sqlalchemy.bindparam("task_name"))
+    if before:
+        # a row comparison, so the page starts with an index seek however deep it is
+        query = query.where(
+            sqlalchemy.tuple_(Runs.c.start, Runs.c.uuid)
+            < sqlalchemy.tuple_(
+                sqlalchemy.bindparam("before_start", type_=sqlalchemy.String),
+                sqlalchemy.bindparam("before_uuid", type_=sqlalchemy.String),
+            )
+        )
+    if since:
+        query = query.where(Runs.c.start >= sqlalchemy.bindparam("since"))
+    if until:
+        query = query.where(Runs.c.start < sqlalchemy.bindparam("until"))
+    if latest:
+        query = query.limit(sqlalchemy.bindparam("latest", type_=sqlalchemy.Integer))
+    return _prepare(query)
+
+
+def _runs_query(
+    *, status=None, task_name=None, latest=None, before=None, since=None, until=None
+):
+    """the query behind get_runs, prepared once for each combination of filters"""
+    if isinstance(status, Status):
+        status = [status]
+    elif status and not isinstance(status, list):
+        raise ValueError("status must be Status or list")
+    values = {}
+    if task_name:
+        values["task_name"] = task_name
+    if latest:
+        values["latest"] = latest
+    if before:
+        values["before_start"], values["before_uuid"] = before
+    if since:
+        values["since"] = since
+    if until:
+        values["until"] = until
+    query = _runs_template(
+        None if status is None else tuple(s.name for s in status),
+        bool(task_name),
+        bool(latest),
+        bool(before),
+        bool(since),
+        bool(until),
+    )
+    return query.bindparams(**values)
+
+
+def _latest_runs_query(n, task_names=None):
+    """the query behind get_latest_runs_by_task"""
+    # a limited index scan per task rather than ranking every run,
+    # runs always belong to a task so tasks without any are skipped
+    latest = (
+        sqlalchemy.select(RUN_COLUMNS)
+        .where(Runs.c.task == Tasks.c.name)
+        .order_by(Runs.c.start.desc(), Runs.c.uuid.desc())
+        .limit(n)
+        .lateral()
+    )
+    query = sqlalchemy.select([latest]).select_from(
+        Tasks.join(latest, sqlalchemy.true())
+    )
+    if task_names is not None:
+        query = query.where(Tasks.c.name.in_(task_names))
+    return query.order_by(latest.c.task, latest.c.start, latest.c.uuid)
+
+
+@attr.s(auto_attribs=True)
+class QueryTiming:
+    count: int = 0
+    # seconds spent waiting for a connection from the pool and running queries
+    wait: float = 0.0
+    execute: float = 0.0
+
+
 def _db_to_run(r):
     logs = ""
     if "logs" in r:
@@ -81,86 +337,425 @@ def _db_to_task(row):
 
 
 class DatabaseStorage:
-    def __init__(self, BOBSLED_DATABASE_URI):
-        self.database = Database(BOBSLED_DATABASE_URI)
+    """
+    Runs, tasks, and users stored in Postgres.
+
+    BOBSLED_DATABASE_POOL_MIN and BOBSLED_DATABASE_POOL_MAX size the connection
+    pool, connections over the minimum are closed after BOBSLED_DATABASE_IDLE_SECONDS
+    unused.  BOBSLED_DATABASE_TIMEOUT limits how long a query can run, in seconds.
+
+    timings has a QueryTiming for each of the frequent queries.
+
+    Tasks are cached in memory, see _cached_tasks.
+    """
+
+    def __init__(
+        self,
+        BOBSLED_DATABASE_URI,
+        BOBSLED_DATABASE_POOL_MIN=None,
+        BOBSLED_DATABASE_POOL_MAX=None,
+        BOBSLED_DATABASE_IDLE_SECONDS=None,
+        BOBSLED_DATABASE_TIMEOUT=None,
+    ):
+        options = {}
+        if BOBSLED_DATABASE_POOL_MIN:
+            options["min_size"] = int(BOBSLED_DATABASE_POOL_MIN)
+        if BOBSLED_DATABASE_POOL_MAX:
+            options["max_size"] = int(BOBSLED_DATABASE_POOL_MAX)
+        if BOBSLED_DATABASE_IDLE_SECONDS:
+            options["max_inactive_connection_lifetime"] = float(
+                BOBSLED_DATABASE_IDLE_SECONDS
+            )
+        if BOBSLED_DATABASE_TIMEOUT:
+            options["command_timeout"] = float(BOBSLED_DATABASE_TIMEOUT)
+        self.database = Database(BOBSLED_DATABASE_URI, **options)
+        self.timings = {}
+        self._tasks = {}
+        self._task_version = None
+        self._tasks_checked = float("-inf")
 
     async def connect(self):
         await self.database.connect()
-        engine = sqlalchemy.create_engine(str(self.database.url))
-        metadata.create_all(engine)
+        await _upgrade_schema(self.database)
+
+    @contextlib.asynccontextmanager
+    async def _timed(self, name):
+        """a pooled connection, timing how long it took to get and how long it was used"""
+        start = time.perf_counter()
+        async with self.database.connection() as connection:
+            acquired = time.perf_counter()
+            yield connection
+        timing = self.timings.setdefault(name, QueryTiming())
+        timing.count += 1
+        timing.wait += acquired - start
+        timing.execute += time.perf_counter() - acquired
+
+    @contextlib.asynccontextmanager
+    async def _transaction(self, name):
+        """
+        A pooled connection in a transaction, statements must run on it.
+
+        databases 0.5 starts ``database.transaction()`` on a fresh connection once
+        the task has used one, leaving ``database.execute`` outside the transaction.
+        Other queries in the task still share this connection, and so the transaction.
+        """
+        async with self._timed(name) as connection:
+            async with connection.transaction():
+                yield connection
 
     async def add_run(self, run):
-        query = Runs.insert()
-        await self.database.execute(query=query, values=_run_to_db(run))
+        values = _run_to_db(run)
+        values["logs"] = ""
+        async with self._timed("add_run") as connection:
+            await connection.execute(ADD_RUN.bindparams(**values))
+            await connection.execute(BUMP_CHANGES)
+        if run.logs:
+            await self.append_logs(run.uuid, 0, run.logs)
 
     async def save_run(self, run):
+        # logs are written with append_logs/replace_logs
         values = _run_to_db(run)
-        uuid = values.pop("uuid")
-        query = Runs.update().where(Runs.c.uuid == uuid).values(**values)
-        await self.database.execute(query=query)
+        values.pop("logs")
+        async with self._timed("save_run") as connection:
+            await connection.execute(SAVE_RUN.bindparams(**values))
+            await connection.execute(BUMP_CHANGES)
+        if run.status.is_terminal():
+            await self.compress_run_logs(run.uuid)
 
-    async def get_run(self, run_id):
-        query = Runs.select().where(Runs.c.uuid == run_id)
-        row = await self.database.fetch_one(query=query)
+    async def claim_queued_run(self, run_id, status, claimed_at):
+        # only one caller gets the row back, whichever process it's in.  run_info
+        # is stored as a JSON string, so it's unwrapped to add the claim time
+        run_info = sqlalchemy.cast(
+            Runs.c.run_info_json.op("#>>")(sqlalchemy.literal_column("'{}'")),
+            postgresql.JSONB,
+        ).op("||")(
+            sqlalchemy.func.jsonb_build_object(
+                sqlalchemy.literal_column("'claimed_at'"),
+                sqlalchemy.cast(claimed_at, sqlalchemy.Text),
+            )
+        )
+        query = (
+            Runs.update()
+            .where(Runs.c.uuid == run_id)
+            .where(Runs.c.status == Status.Queued.name)
+            .values(
+                status=status.name,
+                run_info_json=sqlalchemy.func.to_json(
+                    sqlalchemy.cast(run_info, sqlalchemy.Text)
+                ),
+            )
+            .returning(Runs.c.uuid)
+        )
+        async with self._timed("claim_queued_run") as connection:
+            claimed = await connection.fetch_one(query) is not None
+            if claimed:
+                await connection.execute(BUMP_CHANGES)
+        return claimed
+
+    async def get_run(self, run_id, logs=True):
+        query = GET_RUN if logs else GET_RUN_NO_LOGS
+        async with self._timed("get_run") as connection:
+            row = await connection.fetch_one(query.bindparams(uuid=run_id))
         if row:
-            return _db_to_run(row)
-
-    async def get_runs(self, *, status=None, task_name=None, latest=None):
-        query = sqlalchemy.select(
-            [
-                Runs.c.uuid,
-                Runs.c.task,
-                Runs.c.status,
-                Runs.c.start,
-                Runs.c.end,
-                Runs.c.exit_code,
-                Runs.c.run_info_json,
-            ]
+            run = _db_to_run(row)
+            if logs:
+                run.logs = await self._assemble_logs(row)
+            return run
+
+    async def append_logs(self, run_id, position, text):
+        query = (
+            pg_insert(RunLogs)
+            .values(run=run_id, position=position, text=text)
+            .on_conflict_do_nothing()
+            .returning(RunLogs.c.run)
+        )
+        return await self.database.fetch_one(query=query) is not None
+
+    async def replace_logs(self, run_id, text):
+        async with self._transaction("replace_logs") as connection:
+            await connection.execute(
+                query=RunLogs.delete().where(RunLogs.c.run == run_id)
+            )
+            await connection.execute(
+                query=RunLogs.insert().values(run=run_id, position=0, text=text)
+            )
+
+    async def get_logs(self, run_id, offset=0):
+        async with self._timed("get_logs") as connection:
+            row = await connection.fetch_one(GET_RUN_LOGS.bindparams(uuid=run_id))
+            return await self._assemble_logs(row, offset) if row else ""
+
+    async def _assemble_logs(self, row, offset=0):
+        """
+        Logs are compressed once a run finishes, and runs saved before logs were
+        chunked only have the plain logs column.
+
+        With an offset only the chunks containing text from that offset on are read.
+        """
+        query = (
+            RunLogs.select()
+            .where(RunLogs.c.run == row["uuid"])
+            .order_by(RunLogs.c.position)
+        )
+        if offset:
+            query = query.where(
+                RunLogs.c.position + sqlalchemy.func.length(RunLogs.c.text) > offset
+            )
+        chunks = await self.database.fetch_all(query=query)
+        if row["logs_compressed"]:
+            logs = decompress_logs(row["logs_compressed"])
+            # anything appended after compression
+            logs += "".join(c["text"] for c in chunks if c["position"] >= len(logs))
+            return logs[offset:]
+        elif chunks:
+            start = chunks[0]["position"]
+            return "".join(c["text"] for c in chunks)[offset - start :]
+        return (row["logs"] or "")[offset:]
+
+    async def compress_run_logs(self, run_id):
+        """Replace a finished run's log chunks with a single compressed copy."""
+        async with self._transaction("compress_run_logs") as connection:
+            logs = await self.get_logs(run_id)
+            query = (
+                Runs.update()
+                .where(Runs.c.uuid == run_id)
+                .values(logs="", logs_compressed=compress_logs(logs))
+            )
+            await connection.execute(query=query)
+            await connection.execute(
+                query=RunLogs.delete().where(RunLogs.c.run == run_id)
+            )
+
+    async def compress_finished_logs(self, limit=100):
+        """
+        Compress the logs of up to limit finished runs that are still stored as text.
+
+        Returns the number of runs compressed, for draining older rows in batches.
+        """
+        terminal = [s.name for s in Status if s.is_terminal()]
+        query = (
+            sqlalchemy.select([Runs.c.uuid])
+            .where(Runs.c.status.in_(terminal))
+            .where(Runs.c.logs_compressed.is_(None))
+            .limit(limit)
         )
-        query = query.order_by(Runs.c.start.desc())
-        if isinstance(status, Status):
-            query = query.where(Runs.c.status == status.name)
-        elif isinstance(status, list):
-            query = query.where(Runs.c.status.in_(s.name for s in status))
-        elif status:
-            raise ValueError("status must be Status or list")
-        if task_name:
-            query = query.where(Runs.c.task == task_name)
-        if latest:
-            query = query.limit(latest)
         rows = await self.database.fetch_all(query=query)
+        for row in rows:
+            await self.compress_run_logs(row["uuid"])
+        return len(rows)
 
+    async def get_runs(
+        self,
+        *,
+        status=None,
+        task_name=None,
+        latest=None,
+        before=None,
+        since=None,
+        until=None,
+    ):
+        query = _runs_query(
+            status=status,
+            task_name=task_name,
+            latest=latest,
+            before=before,
+            since=since,
+            until=until,
+        )
+        async with self._timed("get_runs") as connection:
+            rows = await connection.fetch_all(query)
         return [_db_to_run(r) for r in reversed(rows)]
 
-    async def get_tasks(self):
+    async def get_latest_runs_by_task(self, n, task_names=None):
+        """
+        The latest n runs of each task, in one query.
+
+        Returns a dict of task name to runs, ordered like get_runs.
+        """
+        query = _latest_runs_query(n, task_names)
+        runs = {}
+        for row in await self.database.fetch_all(query=query):
+            runs.setdefault(row["task"], []).append(_db_to_run(row))
+        return runs
+
+    async def get_expired_runs(self, *, keep_runs=None, keep_before=None, limit=100):
+        """
+        Finished runs outside the latest keep_runs of their task and started before
+        keep_before, oldest first.  The latest failure of each task is never expired.
+        """
+        failed = Runs.c.status.in_([s.name for s in FAILED_STATUSES])
+        rank = sqlalchemy.func.row_number().over(
+            partition_by=Runs.c.task, order_by=Runs.c.start.desc()
+        )
+        failure_rank = sqlalchemy.func.row_number().over(
+            partition_by=(Runs.c.task, failed), order_by=Runs.c.start.desc()
+        )
+        ranked = sqlalchemy.select(
+            RUN_COLUMNS
+            + [
+                rank.label("rank"),
+                failure_rank.label("failure_rank"),
+                failed.label("failed"),
+            ]
+        ).subquery()
+        terminal = [s.name for s in Status if s.is_terminal()]
+        query = (
+            sqlalchemy.select([ranked])
+            .where(ranked.c.status.in_(terminal))
+            .where(~sqlalchemy.and_(ranked.c.failed, ranked.c.failure_rank == 1))
+        )
+        if keep_runs:
+            query = query.where(ranked.c.rank > keep_runs)
+        if keep_before:
+            query = query.where(ranked.c.start < keep_before)
+        query = query.order_by(ranked.c.start).limit(limit)
+        rows = await self.database.fetch_all(query=query)
+        return [_db_to_run(r) for r in rows]
+
+    async def delete_runs(self, run_ids):
+        async with self._transaction("delete_runs") as connection:
+            await connection.execute(
+                query=RunLogs.delete().where(RunLogs.c.run.in_(run_ids))
+            )
+            await connection.execute(
+                query=Runs.delete().where(Runs.c.uuid.in_(run_ids))
+            )
+        await self.database.execute(query=BUMP_CHANGES)
+
+    async def _fetch_tasks(self):
         query = Tasks.select().order_by(Tasks.c.name.asc())
         rows = await self.database.fetch_all(query=query)
         return [_db_to_task(r) for r in rows]
 
+    async def get_change_version(self):
+        """
+        A number that increases whenever runs or tasks are written, so callers can
+        tell that nothing has changed without reading anything else.
+        """
+        return await self.database.fetch_val(
+            f"SELECT last_value + is_called::int FROM {Changes.name}"
+        )
+
+    async def get_task_version(self):
+        query = sqlalchemy.select([Meta.c.version]).where(Meta.c.key == "tasks")
+        return await self.database.fetch_val(query=query) or 0
+
+    async def _cached_tasks(self):
+        """
+        Tasks by name, kept in memory and only reloaded after the task version has
+        been bumped by a set_tasks call (in any process).
+        """
+        now = time.monotonic()
+        if now - self._tasks_checked >= TASK_VERSION_CHECK_SECONDS:
+            version = await self.get_task_version()
+            if version != self._task_version:
+                tasks = await self._fetch_tasks()
+                self._tasks = {task.name: task for task in tasks}
+                self._task_version = version
+            self._tasks_checked = now
+        return self._tasks
+
+    async def get_tasks(self):
+        return list((await self._cached_tasks()).values())
+
     async def get_task(self, name):
-        query = Tasks.select().where(Tasks.c.name == name)
-        row = await self.database.fetch_one(query=query)
-        if row:
-            return _db_to_task(row)
+        return (await self._cached_tasks()).get(name)
 
     async def set_tasks(self, tasks):
-        seen = set()
-        for task in tasks:
-            seen.add(task.name)
-            dbtask = _task_to_db(task)
-
-            query = Tasks.select().where(Tasks.c.name == task.name)
-            res = await self.database.fetch_all(query=query)
-            if res:
-                query = Tasks.update().where(Tasks.c.name == task.name).values(**dbtask)
-                res = await self.database.execute(query=query)
-            else:
-                query = Tasks.insert()
-                await self.database.execute(query=query, values=dbtask)
-
-        # delete the other tasks
-        query = Tasks.delete().where(~Tasks.c.name.in_(seen))
-        await self.database.execute(query)
+        """
+        Store the task list, writing only tasks that were added or changed.
+
+        Returns the TaskChanges, readers see either the old or new tasks.
+        """
+        async with self._transaction("set_tasks") as connection:
+            stored = await self._fetch_tasks()
+            changes = diff_tasks(stored, tasks)
+            updated = set(changes.updated)
+            rows = [_task_to_db(task) for task in tasks if task.name in updated]
+            for start in range(0, len(rows), UPSERT_BATCH):
+                query = pg_insert(Tasks).values(rows[start : start + UPSERT_BATCH])
+                query = query.on_conflict_do_update(
+                    index_elements=[Tasks.c.name],
+                    set_={
+                        c.name: query.excluded[c.name]
+                        for c in Tasks.c
+                        if not c.primary_key
+                    },
+                )
+                await connection.execute(query=query)
+            if changes.removed:
+                query = Tasks.delete().where(Tasks.c.name.in_(changes.removed))
+                await connection.execute(query=query)
+            if changes.updated or changes.removed:
+                # tells other processes to reload their cached tasks
+                query = (
+                    pg_insert(Meta)
+                    .values(key="tasks", version=1)
+                    .on_conflict_do_update(
+                        index_elements=[Meta.c.key],
+                        set_={"version": Meta.c.version + 1},
+                    )
+                )
+                await connection.execute(query=query)
+        if changes.updated or changes.removed:
+            await self.database.execute(query=BUMP_CHANGES)
+        # the next read reloads
+        self._tasks_checked = float("-inf")
+        return changes
+
+    async def get_schedule(self):
+        rows = await self.database.fetch_all(query=Schedule.select())
+        return [
+            ScheduleEntry(r["task"], r["cron"], r["next_run"], r["last_fired"])
+            for r in rows
+        ]
+
+    async def save_schedule(self, entries):
+        names = [entry.task for entry in entries]
+        async with self._transaction("save_schedule") as connection:
+            await connection.execute(
+                query=Schedule.delete().where(Schedule.c.task.in_(names))
+            )
+            await connection.execute_many(
+                query=Schedule.insert(), values=[attr.asdict(e) for e in entries]
+            )
+
+    async def delete_schedule(self, task_names):
+        query = Schedule.delete().where(Schedule.c.task.in_(task_names))
+        await self.database.execute(query=query)
+
+    async def beat_heartbeat(self, member_id, expires_at):
+        query = (
+            pg_insert(BeatMembers)
+            .values(member=member_id, expires_at=expires_at)
+            .on_conflict_do_update(
+                index_elements=[BeatMembers.c.member],
+                set_={"expires_at": expires_at},
+            )
+        )
+        await self.database.execute(query=query)
+
+    async def get_beat_members(self, now):
+        query = (
+            BeatMembers.select()
+            .where(BeatMembers.c.expires_at > now)
+            .order_by(BeatMembers.c.member)
+        )
+        return [r["member"] for r in await self.database.fetch_all(query=query)]
+
+    async def claim_fire(self, task_name, fire_time):
+        # the primary key makes this atomic, only one beat gets the row back
+        query = (
+            pg_insert(FireClaims)
+            .values(task=task_name, fire_time=fire_time)
+            .on_conflict_do_nothing()
+            .returning(FireClaims.c.task)
+        )
+        return await self.database.fetch_one(query=query) is not None
+
+    async def prune_fire_claims(self, before):
+        query = FireClaims.delete().where(FireClaims.c.fire_time < before)
+        await self.database.execute(query=query)
 
     async def set_user(self, username, password, permissions):
         phash = hash_password(password)
@@ -1,42 +1,216 @@
-from ..base import Status, User
+import time
+import bisect
+from ..base import FAILED_STATUSES, Status, User, diff_tasks
 from ..utils import hash_password, verify_password
 
 
 class InMemoryStorage:
+    """
+    Runs are indexed by uuid, task, and status so lookups don't scan every run,
+    and kept sorted on start for paging, runs that started together are kept in
+    the order they were added.
+
+    Runs are modified in place, save_run keeps the status index up to date.
+    """
+
     def __init__(self):
+        # starts from the clock so it keeps increasing across restarts
+        self.changes = int(time.time() * 1000)
+        self.logs = {}
         self.runs = []
         self.tasks = {}
         self.users = {}
+        self.schedule = {}
+        self.beat_members = {}
+        self.fire_claims = set()
+
+    @property
+    def runs(self):
+        return list(self._runs)
+
+    @runs.setter
+    def runs(self, runs):
+        self.changes += 1
+        self._runs = []
+        self._by_uuid = {}
+        self._by_task = {}
+        self._by_status = {}
+        self._indexed_status = {}
+        self._keys = []
+        self._keys_by_task = {}
+        self._indexed_key = {}
+        for run in runs:
+            self._index_run(run)
+            # like add_run, but logs already stored for the run are kept
+            if run.logs:
+                self.logs.setdefault(run.uuid, {0: run.logs})
+
+    def _index_run(self, run):
+        self._by_uuid[run.uuid] = len(self._runs)
+        self._runs.append(run)
+        self._by_task.setdefault(run.task, []).append(run)
+        self._by_status.setdefault(run.status, {})[run.uuid] = run
+        self._indexed_status[run.uuid] = run.status
+        self._index_key(run)
+
+    def _index_key(self, run):
+        # runs are added in roughly start order, so this is almost always an append
+        key = (run.start, self._by_uuid[run.uuid])
+        bisect.insort(self._keys, key)
+        bisect.insort(self._keys_by_task.setdefault(run.task, []), key)
+        self._indexed_key[run.uuid] = key
+
+    def _unindex_key(self, run):
+        key = self._indexed_key.pop(run.uuid)
+        for keys in (self._keys, self._keys_by_task[run.task]):
+            del keys[bisect.bisect_left(keys, key)]
 
     async def connect(self):
         pass
 
     async def add_run(self, run):
-        self.runs.append(run)
+        self._index_run(run)
+        self.changes += 1
+        if run.logs:
+            await self.append_logs(run.uuid, 0, run.logs)
 
     async def save_run(self, run):
-        # run is modified in place
-        pass
+        # runs are usually modified in place, logs are saved separately
+        self.changes += 1
+        index = self._by_uuid[run.uuid]
+        stored = self._runs[index]
+        if stored is not run:
+            self._runs[index] = run
+            task_runs = self._by_task[run.task]
+            task_runs[task_runs.index(stored)] = run
+        old_status = self._indexed_status[run.uuid]
+        self._by_status[old_status].pop(run.uuid)
+        self._by_status.setdefault(run.status, {})[run.uuid] = run
+        self._indexed_status[run.uuid] = run.status
+        # queued runs get a new start when they're started
+        if self._indexed_key[run.uuid] != (run.start, index):
+            self._unindex_key(run)
+            self._index_key(run)
+
+    async def claim_queued_run(self, run_id, status, claimed_at):
+        if self._indexed_status.get(run_id) != Status.Queued:
+            return False
+        run = self._runs[self._by_uuid[run_id]]
+        run.status = status
+        run.run_info = {**run.run_info, "claimed_at": claimed_at}
+        self.changes += 1
+        self._by_status[Status.Queued].pop(run_id)
+        self._by_status.setdefault(status, {})[run_id] = run
+        self._indexed_status[run_id] = status
+        return True
+
+    async def get_run(self, run_id, logs=True):
+        index = self._by_uuid.get(run_id)
+        if index is not None:
+            run = self._runs[index]
+            if logs:
+                run.logs = await self.get_logs(run_id)
+            return run
+
+    async def append_logs(self, run_id, position, text):
+        chunks = self.logs.setdefault(run_id, {})
+        if position in chunks:
+            return False
+        chunks[position] = text
+        return True
 
-    async def get_run(self, run_id):
-        run = [r for r in self.runs if r.uuid == run_id]
-        if run:
-            return run[0]
+    async def replace_logs(self, run_id, text):
+        self.logs[run_id] = {0: text}
 
-    async def get_runs(self, *, status=None, task_name=None, latest=None):
-        runs = [r for r in self.runs]
+    async def get_logs(self, run_id, offset=0):
+        chunks = self.logs.get(run_id, {})
+        return "".join(chunks[position] for position in sorted(chunks))[offset:]
+
+    async def get_change_version(self):
+        return self.changes
+
+    async def get_runs(
+        self,
+        *,
+        status=None,
+        task_name=None,
+        latest=None,
+        before=None,
+        since=None,
+        until=None,
+    ):
         if isinstance(status, Status):
-            runs = [r for r in runs if r.status == status]
-        elif isinstance(status, list):
-            runs = [r for r in runs if r.status in status]
-        elif status:
+            status = [status]
+        elif status and not isinstance(status, list):
             raise ValueError("status must be Status or list")
+
+        if latest or before or since or until:
+            keys = self._keys_by_task.get(task_name, []) if task_name else self._keys
+            return self._page(keys, status, latest, before, since, until)
         if task_name:
-            runs = [r for r in runs if r.task == task_name]
-        if latest:
-            # runs are in order, so just grab the tail
-            runs = runs[-latest:]
-        return runs
+            runs = self._by_task.get(task_name, [])
+        elif status:
+            runs = [run for s in status for run in self._by_status.get(s, {}).values()]
+            runs.sort(key=lambda r: self._by_uuid[r.uuid])
+        else:
+            runs = self._runs
+        if task_name and status:
+            return [r for r in runs if r.status in status]
+        return list(runs)
+
+    def _page(self, keys, status, latest, before, since, until):
+        """the latest runs in a slice of the sorted keys, oldest first"""
+        low = bisect.bisect_left(keys, (since,)) if since else 0
+        high = bisect.bisect_left(keys, (until,), low) if until else len(keys)
+        if before:
+            start, uuid = before
+            # a cursor run that's since been deleted skips any it started with
+            bound = (start, self._by_uuid.get(uuid, -1))
+            high = min(high, bisect.bisect_left(keys, bound, low))
+        matched = []
+        # walk back from the end of the slice until there are enough
+        for index in range(high - 1, low - 1, -1):
+            run = self._runs[keys[index][1]]
+            if status is None or run.status in status:
+                matched.append(run)
+                if len(matched) == latest:
+                    break
+        return matched[::-1]
+
+    async def get_latest_runs_by_task(self, n, task_names=None):
+        if task_names is None:
+            task_names = list(self._by_task)
+        return {
+            name: [self._runs[key[1]] for key in self._keys_by_task[name][-n:]]
+            for name in task_names
+            if self._keys_by_task.get(name)
+        }
+
+    async def get_expired_runs(self, *, keep_runs=None, keep_before=None, limit=100):
+        expired = []
+        for runs in self._by_task.values():
+            kept_failure = False
+            for rank, run in enumerate(reversed(runs), 1):
+                if run.status in FAILED_STATUSES and not kept_failure:
+                    kept_failure = True
+                elif (
+                    run.status.is_terminal()
+                    and (not keep_runs or rank > keep_runs)
+                    and (not keep_before or run.start < keep_before)
+                ):
+                    expired.append(run)
+        expired.sort(key=lambda r: r.start)
+        return expired[:limit]
+
+    async def delete_runs(self, run_ids):
+        run_ids = set(run_ids)
+        self.runs = [r for r in self._runs if r.uuid not in run_ids]
+        for run_id in run_ids:
+            self.logs.pop(run_id, None)
+
+    async def compress_finished_logs(self, limit=100):
+        # logs are only compressed in the database
+        return 0
 
     async def get_tasks(self):
         return list(self.tasks.values())
@@ -45,7 +219,37 @@ class InMemoryStorage:
         return self.tasks[name]
 
     async def set_tasks(self, tasks):
+        changes = diff_tasks(self.tasks.values(), tasks)
         self.tasks = {task.name: task for task in tasks}
+        if changes.updated or changes.removed:
+            self.changes += 1
+        return changes
+
+    async def get_schedule(self):
+        return list(self.schedule.values())
+
+    async def save_schedule(self, entries):
+        for entry in entries:
+            self.schedule[entry.task] = entry
+
+    async def delete_schedule(self, task_names):
+        for name in task_names:
+            self.schedule.pop(name, None)
+
+    async def beat_heartbeat(self, member_id, expires_at):
+        self.beat_members[member_id] = expires_at
+
+    async def get_beat_members(self, now):
+        return sorted(m for m, expires in self.beat_members.items() if expires > now)
+
+    async def claim_fire(self, task_name, fire_time):
+        if (task_name, fire_time) in self.fire_claims:
+            return False
+        self.fire_claims.add((task_name, fire_time))
+        return True
+
+    async def prune_fire_claims(self, before):
+        self.fire_claims = {c for c in self.fire_claims if c[1] >= before}
 
     async def get_users(self):
         return list(self.users.values())
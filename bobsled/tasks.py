@@ -36,4 +36,4 @@ class TaskProvider:
         tasks = [Task(name=name, **taskdef) for name, taskdef in data.items()]
         for task in tasks:
             task.triggers = [Trigger(**t) for t in task.triggers]
-        await self.storage.set_tasks(tasks)
+        return await self.storage.set_tasks(tasks)
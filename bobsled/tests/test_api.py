@@ -1,14 +1,21 @@
+import datetime
 from starlette.testclient import TestClient
+import asyncio
+import attr
+import pytest
 from ..web import app, bobsled
 from ..utils import hash_password
 from ..base import User, Run, Status
 
 
-def setup():
+@pytest.fixture(autouse=True)
+def reset(monkeypatch):
     # have to get a working check_login, hack for MemoryStorage
     bobsled.storage.users["sample"] = User("sample", hash_password("password"), [])
     bobsled.storage.users["admin"] = User("admin", hash_password("password"), ["admin"])
     bobsled.storage.runs = []
+    # responses are rebuilt as soon as storage changes instead of being shared
+    monkeypatch.setattr("bobsled.web.RESPONSE_CACHE_SECONDS", 0)
 
 
 def test_index():
@@ -47,6 +54,27 @@ def test_index():
     assert hello["recent_statuses"] == ["Running", "Success", "Error", "Success"]
 
 
+def test_index_not_modified():
+    with TestClient(app) as client:
+        client.post("/login", {"username": "sample", "password": "password"})
+        first = client.get("/api/index")
+        etag = first.headers["etag"]
+        unchanged = client.get("/api/index", headers={"If-None-Match": etag})
+        # dates can't tell apart versions built in the same second, so are ignored
+        since = client.get(
+            "/api/index", headers={"If-Modified-Since": "Wed, 01 Jan 2020 00:00:00"}
+        )
+        bobsled.storage.runs = [Run("hello-world", Status.Running, "2020-01-04")]
+        changed = client.get("/api/index", headers={"If-None-Match": etag})
+    assert first.status_code == 200
+    assert unchanged.status_code == 304
+    assert "last-modified" not in first.headers
+    assert since.status_code == 200
+    assert changed.status_code == 200
+    assert changed.headers["etag"] != etag
+    assert len(changed.json()["runs"]) == 1
+
+
 def test_overview():
     bobsled.storage.runs = [
         Run(
@@ -64,6 +92,62 @@ def test_overview():
     assert response.json()["runs"][0]["duration"] == "25:02:03"
 
 
+def test_run_pages():
+    bobsled.storage.runs = [
+        Run("hello-world", Status.Success, f"2020-01-{n:02d}T00:00:00.0", uuid=str(n))
+        for n in range(1, 6)
+    ] + [Run("other", Status.Error, "2020-01-03T12:00:00.0")]
+    with TestClient(app) as client:
+        client.post("/login", {"username": "sample", "password": "password"})
+        first = client.get("/api/task/hello-world?limit=2").json()
+        second = client.get(
+            f"/api/task/hello-world?limit=2&cursor={first['next_cursor']}"
+        ).json()
+        third = client.get(
+            f"/api/task/hello-world?limit=2&cursor={second['next_cursor']}"
+        ).json()
+        latest = client.get("/api/latest_runs?status=Error").json()
+        between = client.get(
+            "/api/latest_runs?since=2020-01-02&until=2020-01-04"
+        ).json()
+        bad = client.get("/api/latest_runs?status=Nope")
+    assert [r["uuid"] for r in first["runs"]] == ["5", "4"]
+    assert [r["uuid"] for r in second["runs"]] == ["3", "2"]
+    assert [r["uuid"] for r in third["runs"]] == ["1"]
+    assert third["next_cursor"] is None
+    assert [r["task"] for r in latest["runs"]] == ["other"]
+    assert len(between["runs"]) == 3
+    assert bad.status_code == 400
+
+
+def test_schedule():
+    with TestClient(app) as client:
+        client.post("/login", {"username": "sample", "password": "password"})
+        response = client.get(
+            "/api/schedule?start=2020-01-01T00:00:00&end=2020-01-02T12:00:00"
+        )
+    assert response.json()["runs"] == [
+        {"task": "full-example", "time": "2020-01-01T04:00:00"},
+        {"task": "full-example", "time": "2020-01-02T04:00:00"},
+    ]
+    assert response.json()["histogram"] == {
+        "2020-01-01T04:00:00": 1,
+        "2020-01-02T04:00:00": 1,
+    }
+    assert response.json()["peak"] == 1
+
+
+def test_schedule_bad_window():
+    with TestClient(app) as client:
+        client.post("/login", {"username": "sample", "password": "password"})
+        responses = [
+            client.get("/api/schedule?start=tomorrow"),
+            client.get("/api/schedule?start=2020-01-02&end=2020-01-01"),
+            client.get("/api/schedule?start=2020-01-01&end=2020-06-01"),
+        ]
+    assert [r.status_code for r in responses] == [400, 400, 400]
+
+
 def test_run_perms():
     # test these together because there's weirdness in running twice
     with TestClient(app) as client:
@@ -92,6 +176,158 @@ def test_websocket():
         assert data["logs"] == "'hello alpine'\n"
 
 
+def test_run_logs():
+    run = Run("hello-world", Status.Success, "2020-01-03T00:00:00.0")
+    bobsled.storage.runs = [run]
+    bobsled.storage.logs[run.uuid] = {0: "one\ntwo\n", 8: "three\n"}
+    with TestClient(app) as client:
+        client.post("/login", {"username": "sample", "password": "password"})
+        full = client.get(f"/api/run/{run.uuid}/logs").json()
+        newer = client.get(f"/api/run/{run.uuid}/logs?offset=4").json()
+        tail = client.get(f"/api/run/{run.uuid}/logs?tail=1").json()
+        missing = client.get("/api/run/nonsense/logs").json()
+        bad = [
+            client.get(f"/api/run/{run.uuid}/logs?offset=-4"),
+            client.get(f"/api/run/{run.uuid}/logs?offset=x"),
+            client.get(f"/api/run/{run.uuid}/logs?tail=1.5"),
+        ]
+    assert full == {
+        "status": "Success",
+        "offset": 0,
+        "next_offset": 14,
+        "logs": "one\ntwo\nthree\n",
+    }
+    assert newer["logs"] == "two\nthree\n"
+    assert newer["offset"] == 4
+    assert tail["logs"] == "three\n"
+    assert tail["offset"] == 8
+    assert tail["next_offset"] == 14
+    assert missing["error"]
+    assert [r.status_code for r in bad] == [400, 400, 400]
+
+
+def test_archived_run(tmp_path, monkeypatch):
+    run = Run(
+        "hello-world",
+        Status.Success,
+        "2020-01-03T00:00:00.0",
+        "2020-01-03T00:01:00.0",
+        logs="done\n",
+    )
+    monkeypatch.setattr(bobsled.archive, "dirname", str(tmp_path))
+    bobsled.archive.write_batch([run], datetime.datetime(2020, 2, 1))
+    with TestClient(app) as client:
+        client.post("/login", {"username": "sample", "password": "password"})
+        detail = client.get(f"/api/run/{run.uuid}").json()
+        logs = client.get(f"/api/run/{run.uuid}/logs?offset=2").json()
+        missing = client.get("/api/run/nonsense").json()
+    assert detail["status"] == "Success"
+    assert detail["logs"] == "done\n"
+    assert detail["duration"] == "0:01:00"
+    assert logs["logs"] == "ne\n"
+    assert missing["error"]
+
+
+def test_websocket_finished_run():
+    run = Run("hello-world", Status.Success, "2020-01-03T00:00:00.0")
+    bobsled.storage.runs = [run]
+    bobsled.storage.logs[run.uuid] = {0: "done\n"}
+    with TestClient(app) as client:
+        client.post("/login", {"username": "sample", "password": "password"})
+        with client.websocket_connect(f"/ws/logs/{run.uuid}") as websocket:
+            data = websocket.receive_json()
+    assert data["status"] == "Success"
+    assert data["logs"] == "done\n"
+    assert data["log_offset"] == 5
+
+
+def _stream_output(monkeypatch, run, output):
+    """stands in for the runner fetching new output on each update, then finishing"""
+    output = iter(output)
+
+    async def update_status(run_id, update_logs=False):
+        position, text = next(output, (None, None))
+        if text:
+            await bobsled.storage.append_logs(run_id, position, text)
+        else:
+            run.status = Status.Success
+        return run
+
+    monkeypatch.setattr(bobsled.run, "update_status", update_status)
+    monkeypatch.setattr("bobsled.web.RUN_STREAM_SECONDS", 0.001)
+
+
+def _slow_snapshots(monkeypatch, read_first):
+    """runs read with their logs take long enough for the stream to move on"""
+    get_run = bobsled.storage.get_run
+
+    async def slow_get_run(run_id, logs=True):
+        if read_first and logs:
+            run = attr.evolve(await get_run(run_id))
+            await asyncio.sleep(0.2)
+            return run
+        if logs:
+            await asyncio.sleep(0.2)
+        return attr.evolve(await get_run(run_id, logs=logs))
+
+    monkeypatch.setattr(bobsled.storage, "get_run", slow_get_run)
+
+
+def _watch(run):
+    """every message sent for a run until it finishes"""
+    with TestClient(app) as client:
+        client.post("/login", {"username": "sample", "password": "password"})
+        with client.websocket_connect(f"/ws/logs/{run.uuid}") as websocket:
+            messages = [websocket.receive_json()]
+            while messages[-1].get("status") != "Success":
+                messages.append(websocket.receive_json())
+    return messages
+
+
+def test_websocket_sends_deltas(monkeypatch):
+    run = Run("hello-world", Status.Running, "2020-01-03T00:00:00.0")
+    bobsled.storage.runs = [run]
+    bobsled.storage.logs[run.uuid] = {0: "one\n"}
+    _stream_output(monkeypatch, run, [(4, "two\n"), (8, "three\n")])
+    messages = _watch(run)
+    assert len(messages) == 3
+    assert messages[0]["logs"] == "one\ntwo\n"
+    assert messages[1] == {"append": "three\n", "log_offset": 14}
+    assert messages[2]["status"] == "Success"
+    assert messages[2]["logs"] == "one\ntwo\nthree\n"
+
+
+def test_websocket_skips_output_in_snapshot(monkeypatch):
+    run = Run("hello-world", Status.Running, "2020-01-03T00:00:00.0")
+    bobsled.storage.runs = [run]
+    bobsled.storage.logs[run.uuid] = {0: "one\n"}
+    _stream_output(monkeypatch, run, [(4, "two\n"), (8, "three\n")])
+    # output published while the first snapshot is read is already in it, the
+    # run finishes after it's read
+    _slow_snapshots(monkeypatch, read_first=False)
+    monkeypatch.setattr("bobsled.web.RUN_STREAM_SECONDS", 0.15)
+    messages = _watch(run)
+    assert messages[0]["status"] == "Running"
+    assert messages[0]["logs"] == "one\ntwo\nthree\n"
+    assert not [m for m in messages if "append" in m]
+    assert messages[-1]["logs"] == "one\ntwo\nthree\n"
+
+
+def test_websocket_resyncs_slow_client(monkeypatch):
+    run = Run("hello-world", Status.Running, "2020-01-03T00:00:00.0")
+    bobsled.storage.runs = [run]
+    bobsled.storage.logs[run.uuid] = {0: "one\n"}
+    _stream_output(monkeypatch, run, [(4, "two\n"), (8, "three\n"), (14, "four\n")])
+    monkeypatch.setattr("bobsled.web.RUN_STREAM_QUEUE_SIZE", 1)
+    # updates pile up while the first snapshot is sent
+    _slow_snapshots(monkeypatch, read_first=True)
+    messages = _watch(run)
+    # what was missed comes as one snapshot rather than every update
+    assert len(messages) == 2
+    assert messages[0]["logs"] == "one\ntwo\n"
+    assert messages[1]["logs"] == "one\ntwo\nthree\nfour\n"
+
+
 def test_update_tasks():
     with TestClient(app) as client:
         client.post("/login", {"username": "admin", "password": "password"})
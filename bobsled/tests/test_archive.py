@@ -0,0 +1,81 @@
+import datetime
+import pytest
+from ..archive import RunArchive
+from ..base import Run, Status
+from ..storages import InMemoryStorage
+
+
+async def _storage():
+    storage = InMemoryStorage()
+    for day in range(1, 8):
+        status = Status.Error if day in (2, 3) else Status.Success
+        run = Run("one", status, start=f"2020-01-0{day}T00:00:00", logs=f"day {day}\n")
+        await storage.add_run(run)
+    await storage.add_run(Run("two", Status.Success, start="2020-01-01T00:00:00"))
+    return storage
+
+
+@pytest.mark.asyncio
+async def test_archive_keep_runs(tmp_path):
+    storage = await _storage()
+    runs = storage.runs
+    archive = RunArchive(
+        storage=storage,
+        BOBSLED_ARCHIVE_DIRNAME=str(tmp_path),
+        BOBSLED_RETENTION_RUNS="3",
+    )
+    assert await archive.archive_expired(batch_size=2) == 2
+    assert await archive.archive_expired() == 1
+    assert await archive.archive_expired() == 0
+
+    # the latest 3 runs and the latest failure are kept
+    kept = await storage.get_runs(task_name="one")
+    assert [r.start[:10] for r in kept] == [
+        "2020-01-03",
+        "2020-01-05",
+        "2020-01-06",
+        "2020-01-07",
+    ]
+    assert len(await storage.get_runs(task_name="two")) == 1
+    archived = [r for r in runs if r.task == "one" and r not in kept]
+    assert len(archived) == 3
+    for run in archived:
+        assert await storage.get_run(run.uuid) is None
+        assert await archive.get_run(run.uuid) == run
+    assert len(list(tmp_path.glob("*.jsonl.gz"))) == 2
+
+
+@pytest.mark.asyncio
+async def test_archive_keep_days_and_read_back(tmp_path):
+    storage = await _storage()
+    first = storage.runs[0]
+    archive = RunArchive(
+        storage=storage,
+        BOBSLED_ARCHIVE_DIRNAME=str(tmp_path),
+        BOBSLED_RETENTION_DAYS="3",
+    )
+    now = datetime.datetime(2020, 1, 8)
+    assert await archive.archive_expired(now) == 4
+    assert await storage.get_runs(task_name="two") == []
+    assert [r.start[:10] for r in await storage.get_runs(task_name="one")] == [
+        "2020-01-03",
+        "2020-01-05",
+        "2020-01-06",
+        "2020-01-07",
+    ]
+
+    assert await storage.get_run(first.uuid) is None
+    run = await archive.get_run(first.uuid)
+    assert run == first
+    assert run.logs == "day 1\n"
+    assert run.status == Status.Success
+    assert await archive.get_run("not-archived") is None
+
+
+@pytest.mark.asyncio
+async def test_archive_disabled(tmp_path):
+    storage = await _storage()
+    archive = RunArchive(storage=storage, BOBSLED_RETENTION_RUNS="1")
+    assert not archive.enabled
+    assert await archive.archive_expired() == 0
+    assert await archive.get_run(storage.runs[0].uuid) is None
@@ -1,4 +1,9 @@
-from ..base import Task
+import asyncio
+import datetime
+import pytest
+from ..base import AdmissionPolicy, Run, RunService, Status, Task
+from ..exceptions import AlreadyRunning
+from ..storages import InMemoryStorage
 
 
 def test_task_entrypoint():
@@ -9,3 +14,158 @@ def test_task_entrypoint():
         "right",
         "way",
     ]
+
+
+class FakeRunService(RunService):
+    STARTING_STATUS = Status.Running
+
+    def __init__(self, storage, admission):
+        self.storage = storage
+        self.admission = admission
+        self.callbacks = []
+        self.started = []
+        self._drain_lock = asyncio.Lock()
+        self._flights = {}
+
+    def start_task(self, task):
+        self.started.append(task.name)
+        return {}
+
+    async def finish(self, run):
+        run.status = Status.Success
+        await self._save_and_followup(run)
+
+
+async def _run_service(tasks, **limits):
+    storage = InMemoryStorage()
+    await storage.set_tasks(tasks)
+    return FakeRunService(storage, AdmissionPolicy(**limits))
+
+
+def test_admission_policy_parsing():
+    policy = AdmissionPolicy("10", "scrape=3, slow=1")
+    assert policy.max_running == 10
+    assert policy.tag_limits == {"scrape": 3, "slow": 1}
+    assert AdmissionPolicy().max_running is None
+
+
+@pytest.mark.asyncio
+async def test_global_limit_queues_and_drains():
+    tasks = [Task(name, "img") for name in ("one", "two", "three")]
+    rs = await _run_service(tasks, BOBSLED_MAX_RUNNING="2")
+    runs = [await rs.run_task(task) for task in tasks]
+    assert [r.status for r in runs] == [Status.Running, Status.Running, Status.Queued]
+    assert rs.started == ["one", "two"]
+
+    # queued runs still count as running for AlreadyRunning
+    with pytest.raises(AlreadyRunning):
+        await rs.run_task(tasks[2])
+
+    await rs.finish(runs[0])
+    assert rs.started == ["one", "two", "three"]
+    assert runs[2].status == Status.Running
+    assert runs[2].run_info["queued_at"]
+
+
+@pytest.mark.asyncio
+async def test_drain_claims_queued_runs():
+    tasks = [Task("one", "img"), Task("two", "img")]
+    storage = InMemoryStorage()
+    await storage.set_tasks(tasks)
+    get_task = storage.get_task
+
+    async def get_task_slowly(name):
+        # let the other service read the queue before either starts the run
+        await asyncio.sleep(0)
+        return await get_task(name)
+
+    storage.get_task = get_task_slowly
+    # two processes draining the same queue, each with its own lock
+    services = [FakeRunService(storage, AdmissionPolicy("2")) for _ in range(2)]
+    await storage.add_run(Run("one", Status.Queued, start="2020-01-01"))
+    await storage.add_run(Run("two", Status.Queued, start="2020-01-02"))
+
+    started = await asyncio.gather(*[rs.drain_queue() for rs in services])
+    assert sorted(run.task for runs in started for run in runs) == ["one", "two"]
+    assert sorted(services[0].started + services[1].started) == ["one", "two"]
+
+
+@pytest.mark.asyncio
+async def test_expire_stale_claims():
+    tasks = [Task("one", "img"), Task("two", "img")]
+    rs = await _run_service(tasks)
+    for task in tasks:
+        await rs.storage.add_run(Run(task.name, Status.Queued, start="2020-01-01"))
+    stale, fresh = await rs.storage.get_runs(status=Status.Queued)
+    # claimed by processes that died before starting them
+    await rs.storage.claim_queued_run(stale.uuid, Status.Running, "2020-01-01")
+    now = datetime.datetime.utcnow().isoformat()
+    await rs.storage.claim_queued_run(fresh.uuid, Status.Running, now)
+    with pytest.raises(AlreadyRunning):
+        await rs.run_task(tasks[0])
+
+    assert await rs.expire_claims() == [stale]
+    assert stale.status == Status.Error
+    assert fresh.status == Status.Running
+    await rs.run_task(tasks[0])
+    assert rs.started == ["one"]
+
+
+@pytest.mark.asyncio
+async def test_tag_limits_and_priority():
+    tasks = [
+        Task("scrape-1", "img", tags=["scrape"]),
+        Task("scrape-2", "img", tags=["scrape"]),
+        Task("scrape-urgent", "img", tags=["scrape"], priority=10),
+        Task("other", "img"),
+    ]
+    rs = await _run_service(tasks, BOBSLED_TAG_LIMITS="scrape=1")
+    runs = {task.name: await rs.run_task(task) for task in tasks}
+    # only one scrape at a time, but untagged tasks aren't held up
+    assert rs.started == ["scrape-1", "other"]
+    assert runs["scrape-2"].status == Status.Queued
+
+    await rs.finish(runs["scrape-1"])
+    assert rs.started == ["scrape-1", "other", "scrape-urgent"]
+    await rs.finish(runs["scrape-urgent"])
+    assert rs.started == ["scrape-1", "other", "scrape-urgent", "scrape-2"]
+
+
+@pytest.mark.asyncio
+async def test_stop_queued_run():
+    tasks = [Task("one", "img"), Task("two", "img")]
+    rs = await _run_service(tasks, BOBSLED_MAX_RUNNING="1")
+    await rs.run_task(tasks[0])
+    queued = await rs.run_task(tasks[1])
+    await rs.stop_run(queued.uuid)
+    assert queued.status == Status.UserKilled
+    assert rs.started == ["one"]
+
+
+@pytest.mark.asyncio
+async def test_save_logs_appends():
+    rs = await _run_service([Task("one", "img")])
+    run = await rs.run_task(Task("one", "img"))
+    await rs._save_logs(run, "first\n")
+    await rs._save_logs(run, "first\nsecond\n")
+    assert rs.storage.logs[run.uuid] == {0: "first\n", 6: "second\n"}
+
+    # another process saved the same output first
+    other = Run("one", Status.Running, uuid=run.uuid, run_info={"log_length": 6})
+    await rs._save_logs(other, "first\nsecond\nthird\n")
+    assert await rs.storage.get_logs(run.uuid) == "first\nsecond\nthird\n"
+
+    await rs._save_logs(run, "replaced", replace=True)
+    assert rs.storage.logs[run.uuid] == {0: "replaced"}
+    assert run.run_info["log_length"] == 8
+
+
+@pytest.mark.asyncio
+async def test_save_logs_replaces_changed_prefix():
+    rs = await _run_service([Task("one", "img")])
+    run = await rs.run_task(Task("one", "img"))
+    await rs._save_logs(run, "first\n")
+    # the start of the output changed, e.g. a secret that's now masked
+    await rs._save_logs(run, "FIRST\nsecond\n")
+    assert rs.storage.logs[run.uuid] == {0: "FIRST\nsecond\n"}
+    assert run.run_info["log_length"] == 13
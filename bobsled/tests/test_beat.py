@@ -1,5 +1,10 @@
+import asyncio
 import datetime
-from ..beat import next_cron
+import collections
+import pytest
+from ..base import ACTIVE_STATUSES, Run, RunService, Status, Task, Trigger
+from ..beat import next_cron, fire_times, task_owner, FireQueue, Beat
+from ..storages import InMemoryStorage
 
 midnight = datetime.datetime(2020, 1, 1, 0, 0)
 noon = datetime.datetime(2020, 1, 1, 12, 0)
@@ -96,3 +101,246 @@ def test_dow():
     assert next_cron("0 4 * * 1,5", wed).weekday() == 5  # saturday
     wed = datetime.datetime(2021, 2, 28)  # a sunday
     assert next_cron("0 4 * * 1,5", wed).weekday() == 1  # tuesday
+
+
+def test_fire_queue():
+    queue = FireQueue()
+    queue.schedule("a", noon)
+    queue.schedule("b", midnight)
+    queue.schedule("c", ninepm)
+    # rescheduling leaves a stale entry behind that must be skipped
+    queue.schedule("a", ninepm)
+    queue.remove("c")
+    assert queue.peek() == midnight
+    assert queue.pop_due(noon) == [("b", midnight)]
+    assert queue.peek() == ninepm
+    assert queue.pop_due(ninepm) == [("a", ninepm)]
+    assert queue.peek() is None
+    assert len(queue) == 0
+
+
+class RecordingRunService:
+    def __init__(self):
+        self.started = []
+
+    async def run_task(self, task):
+        self.started.append(task.name)
+        return task.name
+
+    queue_task = run_task
+
+
+class StartingRunService(RunService):
+    STARTING_STATUS = Status.Running
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.callbacks = []
+        self.started = []
+        self._drain_lock = asyncio.Lock()
+        self._flights = {}
+
+    def start_task(self, task):
+        self.started.append(task.name)
+        return {}
+
+
+@pytest.mark.asyncio
+async def test_beat_fires_due_tasks():
+    storage = InMemoryStorage()
+    tasks = [
+        Task("early", "img", triggers=[Trigger("0 4 * * ?")]),
+        Task("late", "img", triggers=[Trigger("0 16 * * ?")]),
+        Task("disabled", "img", enabled=False, triggers=[Trigger("0 4 * * ?")]),
+    ]
+    await storage.set_tasks(tasks)
+    runs = RecordingRunService()
+    beat = Beat(storage, runs, log=lambda msg: None)
+    await beat.load_tasks(tasks, midnight)
+    assert beat.queue.peek() == datetime.datetime(2020, 1, 1, 4, 0)
+
+    await beat.fire_due(datetime.datetime(2020, 1, 1, 3, 59))
+    assert runs.started == []
+    await beat.fire_due(datetime.datetime(2020, 1, 1, 4, 0))
+    assert runs.started == ["early"]
+    assert beat.queue.get("early") == datetime.datetime(2020, 1, 2, 4, 0)
+    assert beat.queue.peek() == datetime.datetime(2020, 1, 1, 16, 0)
+
+
+@pytest.mark.asyncio
+async def test_beat_load_tasks_keeps_unchanged():
+    beat = Beat(InMemoryStorage(), None, log=lambda msg: None)
+    await beat.load_tasks(
+        [
+            Task("same", "img", triggers=[Trigger("0 4 * * ?")]),
+            Task("changed", "img", triggers=[Trigger("0 4 * * ?")]),
+            Task("removed", "img", triggers=[Trigger("0 4 * * ?")]),
+        ],
+        midnight,
+    )
+    await beat.load_tasks(
+        [
+            Task("same", "img", triggers=[Trigger("0 4 * * ?")]),
+            Task("changed", "img", triggers=[Trigger("0 5 * * ?")]),
+        ],
+        noon,
+    )
+    assert beat.queue.get("same") == datetime.datetime(2020, 1, 1, 4, 0)
+    assert beat.queue.get("changed") == datetime.datetime(2020, 1, 2, 5, 0)
+    assert "removed" not in beat.queue
+
+
+async def _restarted_beat(storage, now, run=None, **kwargs):
+    tasks = await storage.get_tasks()
+    run = run or RecordingRunService()
+    beat = Beat(storage, run, log=lambda msg: None, **kwargs)
+    await beat.load_tasks(tasks, now)
+    await beat.fire_due(now)
+    return beat
+
+
+@pytest.mark.asyncio
+async def test_beat_persists_schedule():
+    storage = InMemoryStorage()
+    await storage.set_tasks([Task("early", "img", triggers=[Trigger("0 4 * * ?")])])
+    beat = await _restarted_beat(storage, midnight)
+    assert storage.schedule["early"].next_run == "2020-01-01T04:00:00"
+
+    # restart after the fire time, the persisted next run is used
+    beat = await _restarted_beat(storage, datetime.datetime(2020, 1, 1, 4, 0, 20))
+    assert beat.run.started == ["early"]
+    assert storage.schedule["early"].next_run == "2020-01-02T04:00:00"
+    assert storage.schedule["early"].last_fired == "2020-01-01T04:00:00"
+
+    # and restarting again doesn't fire it twice
+    beat = await _restarted_beat(storage, datetime.datetime(2020, 1, 1, 4, 0, 40))
+    assert beat.run.started == []
+
+
+@pytest.mark.asyncio
+async def test_beat_doesnt_refire_started_run():
+    storage = InMemoryStorage()
+    await storage.set_tasks([Task("early", "img", triggers=[Trigger("0 4 * * ?")])])
+    await _restarted_beat(storage, midnight)
+    # a run was started but the schedule wasn't saved before a crash
+    await storage.add_run(Run("early", Status.Running, start="2020-01-01T04:00:01"))
+    beat = await _restarted_beat(storage, datetime.datetime(2020, 1, 1, 4, 1))
+    assert beat.run.started == []
+    assert storage.schedule["early"].next_run == "2020-01-02T04:00:00"
+
+
+@pytest.mark.parametrize("catchup,n_runs", [("skip", 0), ("once", 1), ("all", 3)])
+@pytest.mark.asyncio
+async def test_beat_catchup(catchup, n_runs):
+    storage = InMemoryStorage()
+    await storage.set_tasks([Task("hourly", "img", triggers=[Trigger("0 * * * ?")])])
+    await _restarted_beat(storage, midnight)
+    # down for five hours, only the last three fires are within the window
+    rs = StartingRunService(storage)
+    await _restarted_beat(
+        storage,
+        datetime.datetime(2020, 1, 1, 5, 30),
+        run=rs,
+        catchup=catchup,
+        catchup_window=datetime.timedelta(hours=3),
+    )
+    assert storage.schedule["hourly"].next_run == "2020-01-01T06:00:00"
+    assert len(await storage.get_runs(task_name="hourly")) == n_runs
+
+    # the missed runs are queued behind each other, not dropped as already running
+    for n in range(1, n_runs + 1):
+        assert rs.started == ["hourly"] * n
+        (run,) = await storage.get_runs(status=Status.Running)
+        run.status = Status.Success
+        await rs._save_and_followup(run)
+    assert rs.started == ["hourly"] * n_runs
+    assert await storage.get_runs(status=ACTIVE_STATUSES) == []
+
+
+@pytest.mark.asyncio
+async def test_beat_spread_reschedules_persisted():
+    storage = InMemoryStorage()
+    await storage.set_tasks([Task("early", "img", triggers=[Trigger("0 4 * * ?")])])
+    await _restarted_beat(storage, midnight)
+    assert storage.schedule["early"].next_run == "2020-01-01T04:00:00"
+
+    # turning spreading on invalidates the persisted time
+    spread = datetime.timedelta(minutes=30)
+    beat = await _restarted_beat(storage, midnight, spread=spread)
+    expected = beat._schedule("early").next_after(midnight)
+    assert expected != datetime.datetime(2020, 1, 1, 4, 0)
+    assert beat.queue.get("early") == expected
+    assert storage.schedule["early"].next_run == expected.isoformat()
+    assert sum(beat.start_histogram(midnight, noon).values()) == 1
+
+
+def test_task_owner_is_stable():
+    names = [f"task-{i}" for i in range(100)]
+    before = {name: task_owner(name, ["a", "b", "c"]) for name in names}
+    assert set(before.values()) == {"a", "b", "c"}
+    # only the departed member's tasks move
+    after = {name: task_owner(name, ["a", "b"]) for name in names}
+    assert [n for n in names if before[n] != after[n]] == [
+        n for n in names if before[n] == "c"
+    ]
+
+
+@pytest.mark.asyncio
+async def test_sharded_beats_fire_exactly_once():
+    storage = InMemoryStorage()
+    crons = ["*/5 * * * ?", "0 * * * ?", "15,45 * * * ?", "30 2 * * ?"]
+    tasks = [
+        Task(f"task-{i}", "img", triggers=[Trigger(crons[i % len(crons)])])
+        for i in range(40)
+    ]
+    await storage.set_tasks(tasks)
+    runs = RecordingRunService()
+    beats = {
+        name: Beat(
+            storage,
+            runs,
+            log=lambda msg: None,
+            catchup="all",
+            member_id=name,
+        )
+        for name in ("a", "b", "c")
+    }
+    # a and c start together, b joins at 3am and c dies at noon
+    alive = {
+        "a": (midnight, None),
+        "b": (datetime.datetime(2020, 1, 1, 3, 0), None),
+        "c": (midnight, noon),
+    }
+    # members sync at different rates, so they briefly disagree about ownership
+    sync_every = {"a": 2, "b": 1, "c": 3}
+    started = set()
+    end = datetime.datetime(2020, 1, 1, 23, 59)
+    now = midnight
+    minute = 0
+    while now <= end:
+        for name in ("b", "c", "a"):
+            beat = beats[name]
+            since, until = alive[name]
+            if now < since or (until and now >= until):
+                continue
+            if name not in started:
+                await beat.sync_members(now)
+                await beat.load_tasks(await storage.get_tasks(), now)
+                started.add(name)
+            elif minute % sync_every[name] == 0:
+                await beat.sync_members(now)
+            await beat.fire_due(now)
+        now += datetime.timedelta(minutes=1)
+        minute += 1
+
+    # beats only schedule fires strictly after they load
+    expected = fire_times(tasks, midnight + datetime.timedelta(seconds=1), end)
+    assert collections.Counter(runs.started) == {
+        name: len(times) for name, times in expected.items()
+    }
+    assert storage.fire_claims == {
+        (name, t.isoformat()) for name, times in expected.items() for t in times
+    }
+    # everything left is split between the survivors
+    assert set(beats["a"].crons).isdisjoint(beats["b"].crons)
+    assert set(beats["a"].crons) | set(beats["b"].crons) == {t.name for t in tasks}
@@ -0,0 +1,183 @@
+import datetime
+from ..base import Task, Trigger
+import pytest
+from ..cron import (
+    CronSchedule,
+    compile_cron,
+    fire_times,
+    next_run_for_task,
+    next_runs_for_tasks,
+    parse_cron_segment,
+    spread_offset,
+    start_histogram,
+    task_schedule,
+)
+
+midnight = datetime.datetime(2020, 1, 1, 0, 0)
+
+
+def test_parsed_once():
+    assert compile_cron("0 4 * * ?") is compile_cron("0 4 * * ?")
+
+
+def test_next_after_jumps_months():
+    sched = CronSchedule("30 2 1 6 ?")
+    assert sched.next_after(midnight) == datetime.datetime(2020, 6, 1, 2, 30)
+    assert sched.next_after(datetime.datetime(2020, 6, 1, 2, 30)) == datetime.datetime(
+        2021, 6, 1, 2, 30
+    )
+
+
+def test_next_after_leap_day():
+    sched = CronSchedule("0 0 29 2 ?")
+    assert sched.next_after(datetime.datetime(2020, 3, 1)) == datetime.datetime(
+        2024, 2, 29, 0, 0
+    )
+
+
+def test_next_after_never():
+    assert CronSchedule("0 0 30 2 ?").next_after(midnight) is None
+
+
+def test_next_after_seconds():
+    sched = CronSchedule("0 4 * * ?")
+    assert sched.next_after(
+        datetime.datetime(2020, 1, 1, 3, 59, 30)
+    ) == datetime.datetime(2020, 1, 1, 4, 0)
+    assert sched.next_after(
+        datetime.datetime(2020, 1, 1, 4, 0, 30)
+    ) == datetime.datetime(2020, 1, 2, 4, 0)
+
+
+def test_next_n():
+    sched = CronSchedule("0 4,16 * * ?")
+    assert sched.next_n(midnight, 3) == [
+        datetime.datetime(2020, 1, 1, 4, 0),
+        datetime.datetime(2020, 1, 1, 16, 0),
+        datetime.datetime(2020, 1, 2, 4, 0),
+    ]
+
+
+def test_next_runs_for_tasks():
+    tasks = [
+        Task("one", "img", triggers=[Trigger("0 4 * * ?")]),
+        Task("two", "img", triggers=[Trigger("0 4 * * ?")]),
+        Task("three", "img", triggers=[Trigger("0 */6 * * ?")]),
+        Task("manual", "img"),
+    ]
+    assert next_runs_for_tasks(tasks, midnight) == {
+        "one": datetime.datetime(2020, 1, 1, 4, 0),
+        "two": datetime.datetime(2020, 1, 1, 4, 0),
+        "three": datetime.datetime(2020, 1, 1, 6, 0),
+    }
+
+
+def test_parse_segment_steps():
+    minutes = list(range(60))
+    assert parse_cron_segment("*/15", minutes) == [0, 15, 30, 45]
+    assert parse_cron_segment("5-55/10", minutes) == [5, 15, 25, 35, 45, 55]
+    assert parse_cron_segment("50/5", minutes) == [50, 55]
+    assert parse_cron_segment("1,10-12,*/20", minutes) == [0, 1, 10, 11, 12, 20, 40]
+    assert parse_cron_segment("*/10", list(range(1, 32))) == [1, 11, 21, 31]
+
+
+def test_parse_segment_names():
+    sched = CronSchedule("0 4 ? JAN-MAR,dec MON-FRI")
+    assert sched.months == (1, 2, 3, 12)
+    assert sched.weekdays == {0, 1, 2, 3, 4}
+
+
+@pytest.mark.parametrize("bad", ["60 * * * ?", "0 4 * 13 ?", "0 4 * * 7", "a * * * ?"])
+def test_invalid_expressions(bad):
+    with pytest.raises(ValueError):
+        CronSchedule(bad)
+
+
+def test_months():
+    sched = CronSchedule("0 0 1 1,7 ?")
+    assert sched.next_n(midnight, 3) == [
+        datetime.datetime(2020, 7, 1),
+        datetime.datetime(2021, 1, 1),
+        datetime.datetime(2021, 7, 1),
+    ]
+
+
+def test_macros():
+    assert CronSchedule("@daily").next_after(midnight) == datetime.datetime(
+        2020, 1, 2, 0, 0
+    )
+    assert CronSchedule("@hourly").next_after(midnight) == datetime.datetime(
+        2020, 1, 1, 1, 0
+    )
+
+
+def test_multiple_triggers():
+    task = Task("task", "img", triggers=[Trigger("0 16 * * ?"), Trigger("30 4 * * ?")])
+    assert next_run_for_task(task, midnight) == datetime.datetime(2020, 1, 1, 4, 30)
+    assert compile_cron("0 16 * * ?; 30 4 * * ?").next_n(midnight, 3) == [
+        datetime.datetime(2020, 1, 1, 4, 30),
+        datetime.datetime(2020, 1, 1, 16, 0),
+        datetime.datetime(2020, 1, 2, 4, 30),
+    ]
+
+
+def test_between_matches_next_after():
+    sched = CronSchedule("5-55/10 */3 * * 1,3")
+    end = datetime.datetime(2020, 2, 1)
+    expected = []
+    fire_time = sched.next_after(midnight)
+    while fire_time <= end:
+        expected.append(fire_time)
+        fire_time = sched.next_after(fire_time)
+    assert sched.between(midnight, end) == expected
+
+
+def test_fire_times():
+    tasks = [
+        Task("one", "img", triggers=[Trigger("0 4 * * ?")]),
+        Task("two", "img", triggers=[Trigger("0 4,16 * * ?"), Trigger("0 6 * * ?")]),
+        Task("manual", "img"),
+    ]
+    end = datetime.datetime(2020, 1, 1, 23, 59)
+    assert fire_times(tasks, midnight, end) == {
+        "one": [datetime.datetime(2020, 1, 1, 4, 0)],
+        "two": [
+            datetime.datetime(2020, 1, 1, 4, 0),
+            datetime.datetime(2020, 1, 1, 6, 0),
+            datetime.datetime(2020, 1, 1, 16, 0),
+        ],
+    }
+
+
+def test_spread_offset_stable():
+    window = datetime.timedelta(minutes=30)
+    assert spread_offset("task-a", window) == spread_offset("task-a", window)
+    assert spread_offset("task-a", window) < window
+    assert spread_offset("task-a", datetime.timedelta(0)) == datetime.timedelta(0)
+
+
+def test_task_schedule_spread():
+    window = datetime.timedelta(minutes=30)
+    offset = spread_offset("task-a", window)
+    sched = task_schedule("task-a", "0 4 * * ?", window)
+    first = datetime.datetime(2020, 1, 1, 4, 0) + offset
+    assert sched.next_after(midnight) == first
+    assert sched.next_after(first) == first + datetime.timedelta(days=1)
+    assert sched.between(midnight, first) == [first]
+
+
+def test_spread_flattens_histogram():
+    tasks = [
+        Task(f"task-{i}", "img", triggers=[Trigger("0 4 * * ?")]) for i in range(60)
+    ]
+    end = datetime.datetime(2020, 1, 1, 23, 59)
+    times = fire_times(tasks, midnight, end)
+    assert max(start_histogram(t for ts in times.values() for t in ts).values()) == 60
+
+    spread = datetime.timedelta(minutes=30)
+    times = fire_times(tasks, midnight, end, spread)
+    for name, task_times in times.items():
+        assert task_times == task_schedule(name, "0 4 * * ?", spread).between(
+            midnight, end
+        )
+    assert max(start_histogram(t for ts in times.values() for t in ts).values()) < 10
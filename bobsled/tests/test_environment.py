@@ -1,7 +1,7 @@
 import os
 import pytest
 from unittest import mock
-from ..environment import EnvironmentProvider
+from ..environment import EnvironmentProvider, SecretMasker
 from ..base import Environment
 
 
@@ -45,3 +45,32 @@ async def test_get_environment_paramstore():
     assert psenv.get_environment("one") == Environment(
         "one", {"number": "ps-/bobsledtest/number", "word": "ps-/bobsledtest/word"}, []
     )
+
+
+@pytest.mark.parametrize("pattern_min_length", [0, SecretMasker.PATTERN_MIN_LENGTH])
+def test_secret_masker_longest_first(monkeypatch, pattern_min_length):
+    # the single regex pass and the str.replace loop mask the same way
+    monkeypatch.setattr(SecretMasker, "PATTERN_MIN_LENGTH", pattern_min_length)
+    masker = SecretMasker({"abc": "**SHORT**", "abcdef": "**LONG**", "xyz": "**X**"})
+    assert masker.mask("abcdef abc abcde xyzabc") == (
+        "**LONG** **SHORT** **SHORT**de **X****SHORT**"
+    )
+    assert SecretMasker({}).mask("nothing to mask") == "nothing to mask"
+
+
+def test_stream_masker_across_chunks():
+    masker = SecretMasker({"secret": "**S**", "secretive": "**LONG**"})
+    text = "a secret, something secretive, and a secre"
+    for size in range(1, len(text) + 1):
+        stream = masker.stream()
+        chunks = [text[i : i + size] for i in range(0, len(text), size)]
+        output = "".join(stream.feed(chunk) for chunk in chunks) + stream.flush()
+        assert output == masker.mask(text)
+        assert output == "a **S**, something **LONG**, and a secre"
+
+
+@pytest.mark.asyncio
+async def test_mask_variables_recompiled_on_update(simpleenv):
+    assert simpleenv.mask_variables("123") == "123"
+    await simpleenv.update_environments()
+    assert simpleenv.mask_variables("123") == "**ONE/NUMBER**"
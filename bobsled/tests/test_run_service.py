@@ -1,10 +1,10 @@
 import os
 import time
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 import asyncio
 import pytest
 import boto3
-from ..base import Task, Status
+from ..base import Run, RunService, Task, Status
 from ..storages import InMemoryStorage
 from ..runners import LocalRunService, ECSRunService
 from ..tasks import TaskProvider
@@ -179,6 +179,29 @@ async def test_next_tasks(Cls):
     assert len(runs) == 2
 
 
+@pytest.mark.asyncio
+async def test_local_events_finish_runs():
+    storage = InMemoryStorage()
+    task = Task("hello-world", image="hello-world", next_tasks=["next"])
+    task2 = Task("next", image="alpine", entrypoint=["echo", "2"])
+    await storage.set_tasks([task, task2])
+    rs = LocalRunService(storage, env_provider(), [])
+    rs.watch_events()
+    run = await rs.run_task(task)
+
+    # no polling, the die events finish the run and start the next task
+    for _ in range(100):
+        if len(await storage.get_runs(status=Status.Success)) == 2:
+            break
+        await asyncio.sleep(0.1)
+    rs.stop_watching()
+
+    runs = await storage.get_runs(status=Status.Success)
+    assert [r.task for r in runs] == ["hello-world", "next"]
+    assert "Hello from Docker" in runs[0].logs
+    assert run.run_info["container_id"] == runs[0].run_info["container_id"]
+
+
 @pytest.mark.asyncio
 async def test_callback_on_success():
     class Callback:
@@ -212,6 +235,179 @@ async def test_callback_on_error():
     callback.on_error.assert_called_once_with(run, rs.storage)
 
 
+class FakeRunService(RunService):
+    def __init__(self, finish):
+        self.storage = InMemoryStorage()
+        self.callbacks = []
+        self.finish = finish
+        self.calls = []
+        self._drain_lock = asyncio.Lock()
+        self._flights = {}
+
+    async def _update_status(self, run, update_logs=False):
+        self.calls.append((run.uuid, update_logs))
+        # long enough for the other callers to arrive
+        await asyncio.sleep(0.01)
+        if self.finish:
+            run.status = Status.Success
+            await self._save_and_followup(run)
+        return run
+
+
+@pytest.mark.asyncio
+async def test_update_status_shared():
+    class Callback:
+        on_success = Mock(return_value=asyncio.sleep(0))
+
+    rs = FakeRunService(finish=True)
+    rs.callbacks = [Callback()]
+    await rs.storage.set_tasks([Task("hello-world", image="hello-world")])
+    run = Run("hello-world", Status.Running)
+    await rs.storage.add_run(run)
+
+    # the beat, a page of runs and a log stream all asking at once
+    results = await asyncio.gather(
+        rs.update_status(run.uuid),
+        rs.update_status(run.uuid),
+        rs.update_statuses([Run("hello-world", Status.Running, uuid=run.uuid)]),
+    )
+
+    assert len(rs.calls) == 1
+    assert results[0].status == results[2][0].status == Status.Success
+    rs.callbacks[0].on_success.assert_called_once()
+    # finished runs aren't reconciled again
+    await rs.update_status(run.uuid, max_age=0)
+    assert len(rs.calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_update_status_fresh():
+    rs = FakeRunService(finish=False)
+    run = Run("hello-world", Status.Running)
+    await rs.storage.add_run(run)
+
+    await rs.update_status(run.uuid)
+    await rs.update_status(run.uuid)
+    assert rs.calls == [(run.uuid, False)]
+    # a reconciliation without logs doesn't answer a request for them
+    await rs.update_status(run.uuid, update_logs=True)
+    assert rs.calls[-1] == (run.uuid, True)
+    await rs.update_status(run.uuid, max_age=0)
+    assert len(rs.calls) == 3
+
+
+@pytest.mark.asyncio
+async def test_update_status_forgets_flights():
+    rs = FakeRunService(finish=False)
+    running = Run("hello-world", Status.Running)
+    finished = Run("hello-world", Status.Running)
+    for run in (running, finished):
+        await rs.storage.add_run(run)
+    await rs.update_statuses([running, finished])
+    assert set(rs._flights) == {running.uuid, finished.uuid}
+
+    # finished elsewhere, so there's nothing left to reconcile
+    finished.status = Status.Success
+    await rs.storage.save_run(finished)
+    stale = Run("hello-world", Status.Running, uuid=finished.uuid)
+    await rs.update_statuses([stale], max_age=0)
+    assert set(rs._flights) == {running.uuid}
+
+    # flights too old to cover any call are dropped on the next one
+    rs._flights[running.uuid].started -= rs.STATUS_FRESH_SECONDS + 1
+    await rs.update_statuses([])
+    assert rs._flights == {}
+
+
+@pytest.mark.asyncio
+async def test_ecs_update_statuses_batches():
+    # bypass __init__, which needs a real cluster
+    rs = ECSRunService.__new__(ECSRunService)
+    rs._maskers = {}
+    rs._flights = {}
+    rs.storage = InMemoryStorage()
+    rs.callbacks = []
+    rs.cluster_name = "bobsled"
+    rs.get_logs = lambda run: "logs"
+    rs.update_logs = lambda run: asyncio.sleep(0)
+    rs.ecs = Mock()
+
+    def describe_tasks(cluster, tasks):
+        return {
+            "tasks": [
+                {"taskArn": arn, "lastStatus": "RUNNING"}
+                for arn in tasks
+                if arn != "arn-7"
+            ],
+            "failures": [
+                {"arn": arn, "reason": "MISSING"} for arn in tasks if arn == "arn-7"
+            ],
+        }
+
+    rs.ecs.describe_tasks.side_effect = describe_tasks
+    runs = [
+        Run(
+            f"task-{i}",
+            Status.Pending,
+            run_info={"task_arn": f"arn-{i}", "timeout_at": ""},
+        )
+        for i in range(250)
+    ]
+    runs.append(Run("done", Status.Success, run_info={"task_arn": "arn-done"}))
+    for run in runs:
+        await rs.storage.add_run(run)
+
+    updated = await rs.update_statuses(runs)
+
+    assert updated == runs
+    assert [
+        len(call.kwargs["tasks"]) for call in rs.ecs.describe_tasks.call_args_list
+    ] == [100, 100, 50]
+    assert runs[7].status == Status.Missing
+    assert len([r for r in runs if r.status == Status.Running]) == 249
+    assert runs[-1].status == Status.Success
+
+
+@pytest.mark.asyncio
+async def test_ecs_update_logs_incremental():
+    rs = ECSRunService.__new__(ECSRunService)
+    rs._maskers = {}
+    rs.storage = InMemoryStorage()
+    rs.environment = env_provider()
+    rs.log_group = "bobsled"
+    stream = ["one", "two", "three"]
+
+    def get_log_events(logGroupName, logStreamName, startFromHead, nextToken="0"):
+        # one event per page, tokens are positions in the stream
+        pos = int(nextToken)
+        return {
+            "events": [{"message": m} for m in stream[pos : pos + 1]],
+            "nextForwardToken": str(min(pos + 1, len(stream))),
+        }
+
+    run = Run("task", Status.Running, run_info={"task_arn": "arn/1"})
+    await rs.storage.add_run(run)
+    with patch("bobsled.runners.ecs_run_service.boto3") as boto3_mock:
+        boto3_mock.client.return_value.get_log_events.side_effect = get_log_events
+        await rs.update_logs(run)
+        assert run.logs == "one\ntwo\nthree"
+        assert run.run_info["log_token"] == "3"
+        assert run.run_info["log_lines"] == 3
+
+        stream.append("four")
+        calls = boto3_mock.client.return_value.get_log_events.call_count
+        await rs.update_logs(run)
+        assert run.logs == "one\ntwo\nthree\nfour"
+        assert run.run_info["log_lines"] == 4
+        # only the new page and the empty one after it were fetched
+        assert boto3_mock.client.return_value.get_log_events.call_count == calls + 2
+
+        assert rs.get_logs(run) == run.logs
+    # only the new text was appended
+    assert rs.storage.logs[run.uuid] == {0: "one\ntwo\nthree", 13: "\nfour"}
+    assert (await rs.storage.get_run(run.uuid)).logs == "one\ntwo\nthree\nfour"
+
+
 def test_ecs_initialize():
     ENV_FILE = os.path.join(os.path.dirname(__file__), "tasks/tasks.yml")
     storage = InMemoryStorage()
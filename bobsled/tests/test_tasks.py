@@ -11,9 +11,13 @@ GH_API_KEY = os.environ.get("GITHUB_API_KEY")
 async def test_basic_tasks():
     storage = InMemoryStorage()
     tp = TaskProvider(storage=storage, BOBSLED_TASKS_FILENAME=ENV_FILE)
-    await tp.update_tasks()
+    changes = await tp.update_tasks()
     tasks = await storage.get_tasks()
     assert len(tasks) == 3
+    assert len(changes.added) == 3
+    # nothing to write the second time
+    changes = await tp.update_tasks()
+    assert changes.updated == changes.removed == []
 
 
 @pytest.mark.asyncio
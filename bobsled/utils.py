@@ -1,4 +1,5 @@
 import os
+import zlib
 import inspect
 import glob
 import yaml
@@ -14,6 +15,21 @@ def hash_password(password):
     return argon2.hash(password)
 
 
+# compressed logs start with the codec name so it can be changed later
+LOG_CODEC = b"zlib"
+
+
+def compress_logs(text):
+    return LOG_CODEC + b":" + zlib.compress(text.encode())
+
+
+def decompress_logs(data):
+    codec, _, payload = bytes(data).partition(b":")
+    if codec == b"zlib":
+        return zlib.decompress(payload).decode()
+    raise ValueError(f"unknown log codec {codec!r}")
+
+
 def load_args(Cls):
     """
     Parameters that start with BOBSLED_ are read from environment & returned as kwargs.
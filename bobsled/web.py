@@ -1,4 +1,7 @@
 import os
+import json
+import time
+import base64
 import datetime
 import asyncio
 import attr
@@ -13,14 +16,15 @@ from starlette.authentication import (
 )
 from starlette.middleware import Middleware
 from starlette.middleware.authentication import AuthenticationMiddleware
-from starlette.responses import JSONResponse, RedirectResponse
+from starlette.responses import JSONResponse, RedirectResponse, Response
 from starlette.routing import Route, WebSocketRoute, Mount
 from starlette.staticfiles import StaticFiles
 from starlette.templating import Jinja2Templates
 import uvicorn
 import jwt
 
-from .base import Status
+from .base import ACTIVE_STATUSES, Status
+from .cron import fire_times, start_histogram
 from .exceptions import AlreadyRunning
 from .core import bobsled
 
@@ -130,6 +134,16 @@ def _parse_time(time):
     return datetime.datetime.strptime(time, "%Y-%m-%dT%H:%M:%S.%f")
 
 
+async def _load_run(run_id):
+    """a refreshed run with its logs, or an archived one, None if there isn't one"""
+    if await bobsled.storage.get_run(run_id, logs=False):
+        # however many clients are watching, the runner is only asked once a second
+        await bobsled.run.update_status(run_id, update_logs=True)
+        return await bobsled.storage.get_run(run_id)
+    # old links can point to runs that have since been archived
+    return await bobsled.archive.get_run(run_id)
+
+
 def _run2dict(run):
     run = attr.asdict(run)
     run["status"] = run["status"].name
@@ -144,45 +158,210 @@ def _run2dict(run):
     return run
 
 
+# polled responses are shared by every viewer for this long, after that the
+# storage change version decides whether they're built again
+RESPONSE_CACHE_SECONDS = 1
+_responses = {}
+_response_locks = {}
+
+
+@attr.s(auto_attribs=True)
+class _CachedResponse:
+    version: int
+    body: bytes
+    expires: float = 0
+
+
+async def _cached_json(request, build):
+    """
+    Respond with build()'s JSON, rebuilt only when storage has changed since the
+    last build, with an ETag so unchanged polls get a 304.
+
+    There's no Last-Modified, a date has one-second resolution and two versions
+    built in the same second would share it.
+    """
+    path = request.url.path
+    # concurrent requests wait for one build instead of all doing it
+    async with _response_locks.setdefault(path, asyncio.Lock()):
+        cached = _responses.get(path)
+        now = time.monotonic()
+        if not cached or now >= cached.expires:
+            # read before the data, and bumped after writes commit, so a build is
+            # never tagged with a version newer than the data it saw
+            version = await bobsled.storage.get_change_version()
+            if not cached or cached.version != version:
+                cached = _CachedResponse(version, JSONResponse(await build()).body)
+                _responses[path] = cached
+            cached.expires = now + RESPONSE_CACHE_SECONDS
+
+    headers = {"ETag": f'"{cached.version}"', "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if headers["ETag"] in [e.strip() for e in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(cached.body, media_type="application/json", headers=headers)
+
+
 @requires(["authenticated"], redirect="login")
 async def api_index(request):
+    return await _cached_json(request, _index_data)
+
+
+async def _index_data():
     tasks = [attr.asdict(t) for t in await bobsled.storage.get_tasks()]
-    results = await asyncio.gather(
-        *[bobsled.run.get_runs(task_name=t["name"], latest=4) for t in tasks]
-    )
-    for task, latest_runs in zip(tasks, results):
+    results = await bobsled.run.get_latest_runs_by_task(4)
+    for task in tasks:
+        latest_runs = results.get(task["name"])
         if latest_runs:
             task["latest_run"] = _run2dict(latest_runs[0])
             task["recent_statuses"] = [r.status.name for r in latest_runs]
         else:
             task["latest_run"] = None
             task["recent_statuses"] = []
-    return JSONResponse(
-        {
-            "tasks": tasks,
-            "runs": [
-                _run2dict(r) for r in await bobsled.run.get_runs(status=Status.Running)
-            ],
-        }
-    )
+    return {
+        "tasks": tasks,
+        "runs": [
+            _run2dict(r) for r in await bobsled.run.get_runs(status=Status.Running)
+        ],
+    }
+
+
+MAX_PAGE_SIZE = 500
+
+
+def _encode_cursor(run):
+    return base64.urlsafe_b64encode(json.dumps([run.start, run.uuid]).encode()).decode()
+
+
+def _decode_cursor(cursor):
+    try:
+        start, uuid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except TypeError:
+        raise ValueError(f"invalid cursor: {cursor}")
+    return str(start), str(uuid)
+
+
+def _page_params(request, default_size):
+    """
+    The get_runs arguments for a page of runs, from the cursor, limit, status
+    (comma-separated) and since/until (ISO dates) query parameters.
+
+    Raises ValueError if any of them are invalid.
+    """
+    params = request.query_params
+    page = {"latest": min(int(params.get("limit", default_size)), MAX_PAGE_SIZE)}
+    if page["latest"] < 1:
+        raise ValueError("limit must be positive")
+    if params.get("cursor"):
+        page["before"] = _decode_cursor(params["cursor"])
+    if params.get("status"):
+        try:
+            page["status"] = [Status[name] for name in params["status"].split(",")]
+        except KeyError as e:
+            raise ValueError(f"invalid status: {e}")
+    for key in ("since", "until"):
+        if params.get(key):
+            page[key] = datetime.datetime.fromisoformat(params[key]).isoformat()
+    return page
+
+
+async def _runs_page(page, **kwargs):
+    """a page of runs as JSON, with the cursor for the next one if there might be one"""
+    runs = await bobsled.run.get_runs(**page, **kwargs)
+    next_cursor = None
+    if len(runs) == page["latest"]:
+        next_cursor = _encode_cursor(runs[-1])
+    return {"runs": [_run2dict(r) for r in runs], "next_cursor": next_cursor}
+
+
+def _bad_page_response():
+    return JSONResponse({"error": "Invalid page parameters."}, status_code=400)
 
 
 @requires(["authenticated"], redirect="login")
 async def latest_runs(request):
-    return JSONResponse(
-        {"runs": [_run2dict(r) for r in await bobsled.run.get_runs(latest=100)]}
-    )
+    try:
+        page = _page_params(request, 100)
+    except ValueError:
+        return _bad_page_response()
+    if request.query_params:
+        return JSONResponse(await _runs_page(page))
+    # only the first page is polled, so only it is shared
+    return await _cached_json(request, _latest_runs_data)
+
+
+async def _latest_runs_data():
+    return await _runs_page({"latest": 100})
 
 
 @requires(["authenticated"], redirect="login")
 async def task_overview(request):
     task_name = request.path_params["task_name"]
+    try:
+        page = _page_params(request, 40)
+    except ValueError:
+        return _bad_page_response()
     task = await bobsled.storage.get_task(task_name)
-    runs = await bobsled.run.get_runs(
-        task_name=task_name, update_status=True, latest=40
+    data = await _runs_page(page, task_name=task_name, update_status=True)
+    return JSONResponse({"task": attr.asdict(task), **data})
+
+
+# every per-minute cron of every task is expanded over the window
+MAX_SCHEDULE_DAYS = 7
+
+
+def _parse_utc(value):
+    when = datetime.datetime.fromisoformat(value)
+    if when.tzinfo:
+        when = when.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return when
+
+
+def _schedule_window(params):
+    """the start and end of the schedule to show, raises ValueError if invalid"""
+    try:
+        start = _parse_utc(params["start"]) if params.get("start") else None
+        end = _parse_utc(params["end"]) if params.get("end") else None
+    except ValueError:
+        raise ValueError("start and end must be ISO dates")
+    if not start:
+        start = datetime.datetime.utcnow()
+    if not end:
+        end = start + datetime.timedelta(days=1)
+    if end < start:
+        raise ValueError("end must be after start")
+    if end - start > datetime.timedelta(days=MAX_SCHEDULE_DAYS):
+        raise ValueError(f"the schedule can cover at most {MAX_SCHEDULE_DAYS} days")
+    return start, end
+
+
+@requires(["authenticated"], redirect="login")
+async def schedule(request):
+    try:
+        start, end = _schedule_window(request.query_params)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    spread = datetime.timedelta(
+        minutes=int(os.environ.get("BOBSLED_BEAT_SPREAD_MINUTES", "0"))
     )
+    tasks = [t for t in await bobsled.storage.get_tasks() if t.enabled]
+    times = fire_times(tasks, start, end, spread)
+    runs = [
+        {"task": task_name, "time": time.isoformat()}
+        for task_name, task_times in times.items()
+        for time in task_times
+    ]
+    runs.sort(key=lambda r: (r["time"], r["task"]))
+    histogram = start_histogram(t for task_times in times.values() for t in task_times)
     return JSONResponse(
-        {"task": attr.asdict(task), "runs": [_run2dict(r) for r in runs]}
+        {
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "runs": runs,
+            "histogram": {
+                minute.isoformat(): n for minute, n in sorted(histogram.items())
+            },
+            "peak": max(histogram.values(), default=0),
+        }
     )
 
 
@@ -201,10 +380,50 @@ async def run_task(request):
 
 @requires(["authenticated"], redirect="login")
 async def run_detail(request):
+    run = await _load_run(request.path_params["run_id"])
+    if not run:
+        return JSONResponse({"error": "No such run."})
+    return JSONResponse(_run2dict(run))
+
+
+@requires(["authenticated"], redirect="login")
+async def run_logs(request):
+    """
+    Part of a run's stored logs.
+
+    offset is a character offset to start from, tail limits the response to the
+    last n lines.  next_offset can be passed as offset to fetch only newer output.
+    """
     run_id = request.path_params["run_id"]
-    run = await bobsled.run.update_status(run_id, update_logs=True)
-    rundata = _run2dict(run)
-    return JSONResponse(rundata)
+    try:
+        offset = int(request.query_params.get("offset", 0))
+        tail = int(request.query_params.get("tail", 0))
+        if offset < 0 or tail < 0:
+            raise ValueError()
+    except ValueError:
+        return JSONResponse(
+            {"error": "offset and tail must be non-negative integers."},
+            status_code=400,
+        )
+    run = await bobsled.storage.get_run(run_id, logs=False)
+    if run:
+        logs = await bobsled.storage.get_logs(run_id, offset)
+    else:
+        run = await bobsled.archive.get_run(run_id)
+        if not run:
+            return JSONResponse({"error": "No such run."})
+        logs = run.logs[offset:]
+    next_offset = offset + len(logs)
+    if tail:
+        logs = "".join(logs.splitlines(keepends=True)[-tail:])
+    return JSONResponse(
+        {
+            "status": run.status.name,
+            "offset": next_offset - len(logs),
+            "next_offset": next_offset,
+            "logs": logs,
+        }
+    )
 
 
 @requires(["authenticated"], redirect="login")
@@ -236,17 +455,162 @@ async def beat_websocket(websocket):
     await websocket.close()
 
 
+# however many clients watch a run, one producer polls it this often, and a
+# client that falls this many updates behind gets a snapshot instead of them
+RUN_STREAM_SECONDS = 1
+RUN_STREAM_QUEUE_SIZE = 16
+# sent to subscribers in place of an update
+_RESYNC = "resync"
+_FINISHED = "finished"
+_run_streams = {}
+
+
+class _RunStream:
+    """The subscribers watching one run, fed by a single producer task."""
+
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self.queues = set()
+        self.producer = asyncio.ensure_future(_produce_run_updates(self))
+
+    def publish(self, message):
+        for queue in self.queues:
+            if queue.full():
+                # coalesce everything a slow subscriber missed into one snapshot
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(_FINISHED if message == _FINISHED else _RESYNC)
+            else:
+                queue.put_nowait(message)
+
+
+def _subscribe(run_id):
+    """a queue of updates to the run, the first subscriber starts its producer"""
+    stream = _run_streams.get(run_id)
+    if not stream:
+        stream = _run_streams[run_id] = _RunStream(run_id)
+    queue = asyncio.Queue(RUN_STREAM_QUEUE_SIZE)
+    stream.queues.add(queue)
+    return queue
+
+
+def _unsubscribe(run_id, queue):
+    """the last subscriber leaving stops the producer"""
+    stream = _run_streams.get(run_id)
+    if stream:
+        stream.queues.discard(queue)
+        if not stream.queues:
+            stream.producer.cancel()
+            del _run_streams[run_id]
+
+
+async def _produce_run_updates(stream):
+    """
+    Refresh the run until it finishes, publishing the fields that changed plus
+    new output as "append", with "log_offset" being where the output ends.
+    """
+    run_id = stream.run_id
+    try:
+        run = await bobsled.storage.get_run(run_id, logs=False)
+        last = _run2dict(run)
+        offset = len(await bobsled.storage.get_logs(run_id))
+        while run.status in ACTIVE_STATUSES:
+            await asyncio.sleep(RUN_STREAM_SECONDS)
+            await bobsled.run.update_status(run_id, update_logs=True)
+            run = await bobsled.storage.get_run(run_id, logs=False)
+            if run.status not in ACTIVE_STATUSES:
+                break
+            current = _run2dict(run)
+            changes = {k: v for k, v in current.items() if last.get(k) != v}
+            changes.pop("logs", None)
+            new_logs = await bobsled.storage.get_logs(run_id, offset)
+            if new_logs:
+                offset += len(new_logs)
+                changes["append"] = new_logs
+                changes["log_offset"] = offset
+            if changes:
+                stream.publish(changes)
+            last = current
+    except Exception as e:
+        print("error streaming run", run_id, e)
+    finally:
+        if _run_streams.get(run_id) is stream:
+            del _run_streams[run_id]
+        # subscribers finish with a snapshot of the run as stored
+        stream.publish(_FINISHED)
+
+
+def _catch_up(message, offset):
+    """
+    The part of a published update a subscriber that has the logs up to offset
+    still needs, or None if there's a gap and it needs a snapshot.
+    """
+    message = dict(message)
+    if "append" in message:
+        end = message["log_offset"]
+        start = end - len(message["append"])
+        if start > offset:
+            return None
+        if end <= offset:
+            del message["append"], message["log_offset"]
+        else:
+            message["append"] = message["append"][offset - start :]
+    return message
+
+
+async def _wait_for_disconnect(websocket):
+    while (await websocket.receive())["type"] != "websocket.disconnect":
+        pass
+
+
 @requires(["authenticated"], redirect="login")
 async def websocket_endpoint(websocket):
+    """
+    Stream a run: first a snapshot of the whole run including its logs, then
+    only changed fields plus new output as "append", with "log_offset" tracking
+    how much of the logs the client has.  A snapshot is sent again when the run
+    ends, or if the client falls behind.
+    """
     await websocket.accept()
     run_id = websocket.path_params["run_id"]
-    while True:
-        run = await bobsled.run.update_status(run_id, update_logs=True)
-        rundict = _run2dict(run)
-        await websocket.send_json(rundict)
-        if run.status not in (Status.Running, Status.Pending):
-            break
-        await asyncio.sleep(1)
+    run = await _load_run(run_id)
+    if not run:
+        await websocket.close()
+        return
+    if run.status not in ACTIVE_STATUSES:
+        await websocket.send_json({**_run2dict(run), "log_offset": len(run.logs)})
+        await websocket.close()
+        return
+
+    queue = _subscribe(run_id)
+    disconnect = asyncio.ensure_future(_wait_for_disconnect(websocket))
+    try:
+        # subscribed first so nothing published after this snapshot is missed
+        message = _RESYNC
+        while True:
+            if message in (_RESYNC, _FINISHED):
+                run = await bobsled.storage.get_run(run_id)
+                offset = len(run.logs)
+                await websocket.send_json({**_run2dict(run), "log_offset": offset})
+                if message == _FINISHED:
+                    break
+            else:
+                update = _catch_up(message, offset)
+                if update is None:
+                    message = _RESYNC
+                    continue
+                offset = update.get("log_offset", offset)
+                if update:
+                    await websocket.send_json(update)
+            get = asyncio.ensure_future(queue.get())
+            await asyncio.wait([get, disconnect], return_when=asyncio.FIRST_COMPLETED)
+            if not get.done():
+                get.cancel()
+                return
+            message = get.result()
+    finally:
+        disconnect.cancel()
+        _unsubscribe(run_id, queue)
     await websocket.close()
 
 
@@ -267,7 +631,9 @@ app = Starlette(
         Route("/api/latest_runs", latest_runs),
         Route("/api/task/{task_name}", task_overview),
         Route("/api/task/{task_name}/run", run_task, methods=["POST"]),
+        Route("/api/schedule", schedule),
         Route("/api/run/{run_id}", run_detail),
+        Route("/api/run/{run_id}/logs", run_logs),
         Route("/api/run/{run_id}/stop", stop_run, methods=["POST"]),
         Route("/api/update_config", update_config, methods=["POST"]),
         # websockets
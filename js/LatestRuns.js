@@ -7,7 +7,9 @@ class LatestRuns extends React.Component {
     super(props);
     this.state = {
       runs: [],
+      next_cursor: null,
     };
+    this.loadMore = this.loadMore.bind(this);
   }
 
   componentDidMount() {
@@ -16,11 +18,26 @@ class LatestRuns extends React.Component {
       .then(data => this.setState(data));
   }
 
+  loadMore() {
+    fetch("/api/latest_runs?cursor=" + this.state.next_cursor)
+      .then(response => response.json())
+      .then(data =>
+        this.setState({
+          runs: this.state.runs.concat(data.runs),
+          next_cursor: data.next_cursor,
+        })
+      );
+  }
+
   render() {
     return (
       <section className="section">
         <div className="container">
-          <RunList title="Latest Runs" runs={this.state.runs} />
+          <RunList
+            title="Latest Runs"
+            runs={this.state.runs}
+            onMore={this.state.next_cursor ? this.loadMore : null}
+          />
         </div>
       </section>
     );
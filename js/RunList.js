@@ -44,6 +44,11 @@ function RunList(props) {
         </thead>
         <tbody>{rows}</tbody>
       </table>
+      {props.onMore ? (
+        <a className="button is-centered" onClick={props.onMore}>
+          Older Runs
+        </a>
+      ) : null}
     </div>
   );
 }
@@ -23,12 +23,15 @@ class RunPage extends React.Component {
   componentDidMount() {
     this.state.ws.onmessage = (evt) => {
       const message = JSON.parse(evt.data);
-      this.setState(message);
+      // the socket starts with a snapshot of the run, after that only changes
+      // and new output are sent
+      if ("append" in message) {
+        const { append, ...changes } = message;
+        this.setState((state) => ({ ...changes, logs: state.logs + append }));
+      } else {
+        this.setState(message);
+      }
     };
-
-    fetch("/api/run/" + this.props.match.params.run_id)
-      .then((response) => response.json())
-      .then((data) => this.setState(data));
   }
 
   render() {
@@ -10,8 +10,10 @@ class TaskPage extends React.Component {
       task_name: this.props.match.params.task_name,
       task: {},
       runs: [],
+      next_cursor: null,
     };
     this.startRun = this.startRun.bind(this);
+    this.loadMore = this.loadMore.bind(this);
   }
 
   componentDidMount() {
@@ -20,6 +22,19 @@ class TaskPage extends React.Component {
       .then((data) => this.setState(data));
   }
 
+  loadMore() {
+    fetch(
+      "/api/task/" + this.state.task_name + "?cursor=" + this.state.next_cursor
+    )
+      .then((response) => response.json())
+      .then((data) =>
+        this.setState({
+          runs: this.state.runs.concat(data.runs),
+          next_cursor: data.next_cursor,
+        })
+      );
+  }
+
   startRun() {
     const outerThis = this;
     fetch("/api/task/" + this.state.task_name + "/run", { method: "POST" })
@@ -118,6 +133,7 @@ class TaskPage extends React.Component {
               title="Recent Runs"
               runs={this.state.runs}
               hideTask="true"
+              onMore={this.state.next_cursor ? this.loadMore : null}
             />
           </div>
         </div>
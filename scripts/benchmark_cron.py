@@ -0,0 +1,114 @@
+"""
+Compare the compiled CronSchedule against the original brute-force next_cron.
+
+Usage: python scripts/benchmark_cron.py [number of tasks]
+"""
+
+import sys
+import time
+import random
+import datetime
+from bobsled.base import Task, Trigger
+from bobsled.cron import next_cron, next_runs_for_tasks
+
+
+def legacy_parse_cron_segment(segment, star_equals):
+    if segment == "*":
+        return star_equals
+    elif "," in segment:
+        return sorted([int(n) for n in segment.split(",")])
+    elif "-" in segment:
+        start, end = segment.split("-")
+        return list(range(int(start), int(end) + 1))
+    elif segment.startswith("*/"):
+        n = int(segment[2:])
+        return list(range(0, 24, n))
+    elif segment.isdigit():
+        return [int(segment)]
+    else:
+        raise ValueError(segment)
+
+
+def legacy_next_cron(cronstr, after):
+    """the pre-CronSchedule implementation, kept here for comparison"""
+    minute, hour, day, month, dow = cronstr.split()
+
+    days = legacy_parse_cron_segment(day, list(range(1, 32)))
+    minutes = legacy_parse_cron_segment(minute, list(range(60)))
+    hours = legacy_parse_cron_segment(hour, list(range(24)))
+    if dow != "?":
+        dow = legacy_parse_cron_segment(dow, list(range(7)))
+
+    next_time = None
+    for month in range(1, 13):
+        for day in days:
+            for hour in hours:
+                for minute in minutes:
+                    try:
+                        next_time = after.replace(
+                            month=month,
+                            day=day,
+                            hour=hour,
+                            minute=minute,
+                            second=0,
+                            microsecond=0,
+                        )
+                        if dow != "?" and next_time.weekday() not in dow:
+                            continue
+                    except ValueError:
+                        continue
+                    if next_time > after:
+                        return next_time
+
+    if after.month == 12:
+        return next_time.replace(
+            day=days[0], hour=hours[0], minute=minutes[0], month=1, year=after.year + 1
+        )
+
+
+CRONS = [
+    "0 4 * * ?",
+    "0 4,16 * * ?",
+    "0 */6 * * ?",
+    "0 11-13 * * ?",
+    "0,15,30,45 * * * ?",
+    "0 0 1 * ?",
+    "0 0 1,15 * ?",
+    "0 4 * * 0",
+    "30 2 * * 1,5",
+]
+
+
+def timed(label, func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:>40}: {elapsed * 1000:9.2f}ms")
+    return elapsed
+
+
+def main():
+    n_tasks = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    random.seed(0)
+    tasks = [
+        Task(f"task-{i}", "image", triggers=[Trigger(random.choice(CRONS))])
+        for i in range(n_tasks)
+    ]
+    # late in the month so the brute force has to walk through most of the year
+    after = datetime.datetime(2020, 11, 27, 22, 30)
+
+    print(f"{n_tasks} tasks, {len(CRONS)} distinct cron expressions")
+    legacy = timed(
+        "legacy next_cron per task",
+        lambda: [legacy_next_cron(t.triggers[0].cron, after) for t in tasks],
+    )
+    compiled = timed(
+        "CronSchedule per task",
+        lambda: [next_cron(t.triggers[0].cron, after) for t in tasks],
+    )
+    batch = timed("next_runs_for_tasks", lambda: next_runs_for_tasks(tasks, after))
+    print(f"speedup per task: {legacy / compiled:.1f}x, batch: {legacy / batch:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
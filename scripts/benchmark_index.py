@@ -0,0 +1,67 @@
+"""
+Compare the dashboard's old per-task run queries against get_latest_runs_by_task.
+
+Uses InMemoryStorage, or the database in BOBSLED_TEST_DATABASE if set (its
+task and run tables are cleared first).
+
+Usage: python scripts/benchmark_index.py [runs per task]
+"""
+
+import os
+import sys
+import time
+import asyncio
+from bobsled.base import Run, Status, Task
+from bobsled.storages import DatabaseStorage, InMemoryStorage
+from bobsled.storages.database import RunLogs, Runs, Tasks
+
+TASK_COUNTS = [100, 500, 1500]
+
+
+async def make_storage():
+    uri = os.environ.get("BOBSLED_TEST_DATABASE")
+    if not uri:
+        return InMemoryStorage()
+    storage = DatabaseStorage(uri)
+    await storage.connect()
+    await storage.database.execute(RunLogs.delete())
+    await storage.database.execute(Runs.delete())
+    await storage.database.execute(Tasks.delete())
+    return storage
+
+
+async def per_task(storage, tasks):
+    """the pre-get_latest_runs_by_task implementation, kept here for comparison"""
+    return await asyncio.gather(
+        *[storage.get_runs(task_name=t.name, latest=4) for t in tasks]
+    )
+
+
+async def timed(label, coro):
+    start = time.perf_counter()
+    await coro
+    elapsed = time.perf_counter() - start
+    print(f"{label:>40}: {elapsed * 1000:9.2f}ms")
+
+
+async def main():
+    runs_per_task = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    storage = await make_storage()
+    print(f"{storage.__class__.__name__}, {runs_per_task} runs per task")
+    for n_tasks in TASK_COUNTS:
+        tasks = [Task(f"task-{i}", "image") for i in range(n_tasks)]
+        await storage.set_tasks(tasks)
+        for task in tasks:
+            # runs added for earlier task counts are kept
+            existing = await storage.get_runs(task_name=task.name)
+            for n in range(len(existing), runs_per_task):
+                start = f"2020-01-01T{n // 60:02d}:{n % 60:02d}:00"
+                await storage.add_run(Run(task.name, Status.Success, start=start))
+
+        print(f"{n_tasks} tasks")
+        await timed("get_runs per task", per_task(storage, tasks))
+        await timed("get_latest_runs_by_task", storage.get_latest_runs_by_task(4))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
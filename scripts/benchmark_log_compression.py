@@ -0,0 +1,71 @@
+"""
+Report compression ratio and latency for run logs.
+
+Logs are generated to look like scraper output: timestamped request lines with
+varying URLs, periodic progress lines and the occasional traceback.
+
+Usage: python scripts/benchmark_log_compression.py [number of lines]
+"""
+
+import sys
+import time
+import random
+import statistics
+from bobsled.utils import compress_logs, decompress_logs
+
+TEMPLATES = [
+    "{ts} INFO scrapelib: GET - 'https://legislature.example.gov/bills/{n}' (200)",
+    "{ts} INFO scrapelib: GET - 'https://legislature.example.gov/votes/{n}.pdf' (200)",
+    "{ts} INFO openstates: save bill HB {n} as bill_{uuid}.json",
+    "{ts} INFO openstates: save vote_event {n} as vote_event_{uuid}.json",
+    "{ts} WARNING openstates: no sponsors found for HB {n}",
+]
+TRACEBACK = """Traceback (most recent call last):
+  File "/opt/openstates/scrapers/ex/bills.py", line 212, in scrape_bill
+    sponsor = page.xpath("//td[@class='sponsor']/text()")[0]
+IndexError: list index out of range"""
+
+
+def make_logs(n_lines, rng):
+    lines = []
+    for i in range(n_lines):
+        ts = f"2020-01-01 04:{i // 3600 % 60:02d}:{i // 60 % 60:02d}"
+        if i % 500 == 499:
+            lines.append(TRACEBACK)
+        elif i % 100 == 99:
+            lines.append(f"{ts} INFO openstates: {i} objects saved")
+        else:
+            lines.append(
+                rng.choice(TEMPLATES).format(
+                    ts=ts, n=rng.randint(1, 5000), uuid=f"{rng.getrandbits(64):016x}"
+                )
+            )
+    return "\n".join(lines)
+
+
+def timed(func, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return result, statistics.median(times)
+
+
+def main():
+    n_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    logs = make_logs(n_lines, random.Random(0))
+    raw_size = len(logs.encode())
+
+    compressed, write_time = timed(lambda: compress_logs(logs))
+    _, read_time = timed(lambda: decompress_logs(compressed))
+
+    print(f"{n_lines} lines, {raw_size / 1024:.0f}KiB of logs")
+    print(f"{'compressed size':>20}: {len(compressed) / 1024:9.0f}KiB")
+    print(f"{'ratio':>20}: {raw_size / len(compressed):9.1f}x")
+    print(f"{'compress':>20}: {write_time * 1000:9.2f}ms")
+    print(f"{'decompress':>20}: {read_time * 1000:9.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Compare the compiled SecretMasker against the original per-secret str.replace loop.
+
+The single regex pass only beats str.replace on logs of tens of megabytes,
+SecretMasker.mask picks between them on the length of the text.
+
+Usage: python scripts/benchmark_masking.py [log size in MB] [number of secrets]
+"""
+
+import sys
+import time
+import random
+import string
+from bobsled.base import Environment
+from bobsled.environment import SecretMasker
+
+LINE = (
+    "2020-01-01 04:00:00 INFO scrapelib: "
+    "GET - 'https://legislature.example.gov/bills/{n}' (200)\n"
+)
+
+
+def legacy_mask_variables(environments, string):
+    """the pre-SecretMasker implementation, kept here for comparison"""
+    for env_name in list(environments.keys()):
+        env = environments[env_name]
+        for var, value in env.values.items():
+            if var not in env.unmasked:
+                string = string.replace(
+                    str(value), f"**{env_name.upper()}/{var.upper()}**"
+                )
+    return string
+
+
+def make_environments(n_secrets, rng):
+    alphabet = string.ascii_letters + string.digits
+    environments = {}
+    for e in range(n_secrets // 10):
+        values = {
+            f"var{v}": "".join(rng.choices(alphabet, k=rng.randint(8, 40)))
+            for v in range(10)
+        }
+        environments[f"env{e}"] = Environment(f"env{e}", values, [])
+    return environments
+
+
+def make_log(size, secrets, rng):
+    lines = []
+    total = 0
+    while total < size:
+        line = LINE.format(n=rng.randint(1, 5000))
+        if rng.random() < 0.001:
+            line = line[:-1] + f" token={rng.choice(secrets)}\n"
+        lines.append(line)
+        total += len(line)
+    return "".join(lines)
+
+
+def timed(label, func):
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:>40}: {elapsed:9.2f}s")
+    return result
+
+
+def stream_mask(masker, log, chunk_size=64 * 1024):
+    stream = masker.stream()
+    output = [
+        stream.feed(log[i : i + chunk_size]) for i in range(0, len(log), chunk_size)
+    ]
+    output.append(stream.flush())
+    return "".join(output)
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    n_secrets = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    rng = random.Random(0)
+    environments = make_environments(n_secrets, rng)
+    secrets = [v for env in environments.values() for v in env.values.values()]
+    log = make_log(size_mb * 1024 * 1024, secrets, rng)
+
+    print(f"{len(log) / 1024 / 1024:.0f}MB log, {len(secrets)} secrets")
+    masker = timed(
+        "compile",
+        lambda: SecretMasker(
+            {
+                str(value): f"**{name.upper()}/{var.upper()}**"
+                for name, env in environments.items()
+                for var, value in env.values.items()
+            }
+        ),
+    )
+    legacy = timed(
+        "legacy str.replace loop", lambda: legacy_mask_variables(environments, log)
+    )
+    compiled = timed("SecretMasker.mask", lambda: masker.mask(log))
+    masker.PATTERN_MIN_LENGTH = 0
+    single_pass = timed("SecretMasker.mask, regex pass", lambda: masker.mask(log))
+    streamed = timed("StreamMasker, 64KiB chunks", lambda: stream_mask(masker, log))
+    assert legacy == compiled == single_pass == streamed
+
+
+if __name__ == "__main__":
+    main()
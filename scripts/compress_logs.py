@@ -0,0 +1,35 @@
+"""
+Compress the logs of finished runs stored before compression was added.
+
+New runs are compressed when they finish, this only needs to be run once after
+upgrading, it can be stopped and restarted at any point.
+
+Usage: python scripts/compress_logs.py [batch size]
+"""
+
+import sys
+import time
+import asyncio
+from bobsled.core import bobsled
+
+
+async def compress_all(batch_size):
+    await bobsled.initialize()
+    total = 0
+    start = time.perf_counter()
+    while True:
+        n = await bobsled.storage.compress_finished_logs(limit=batch_size)
+        if not n:
+            break
+        total += n
+        print(f"compressed {total} runs ({time.perf_counter() - start:.0f}s)")
+    print(f"done, {total} runs compressed")
+
+
+def main():
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    asyncio.run(compress_all(batch_size))
+
+
+if __name__ == "__main__":
+    main()
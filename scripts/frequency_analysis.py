@@ -28,11 +28,10 @@ def recommend_frequency_for_task(runs):
 async def analyze_frequency():
     await bobsled.initialize()
     tasks = [attr.asdict(t) for t in await bobsled.storage.get_tasks()]
-    results = await asyncio.gather(
-        *[bobsled.run.get_runs(task_name=t["name"], latest=4) for t in tasks]
-    )
+    results = await bobsled.run.get_latest_runs_by_task(4)
     recommendations = []
-    for task, latest_runs in zip(tasks, results):
+    for task in tasks:
+        latest_runs = results.get(task["name"])
         # make recommendations for scrape tasks that have runs
         if latest_runs and '-scrape' in task['name']:
             if all(run.status is Status.Success for run in latest_runs):